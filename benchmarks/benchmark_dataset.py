@@ -0,0 +1,33 @@
+import pytest
+from conftest import WINDOW_LEN
+from h5_dataset import H5_DATASET, process_pressure_images
+
+def benchmark_h5_load(benchmark, data_root, track_memory):
+
+    track_memory(H5_DATASET, 1, 1, use_cache=False)
+    benchmark(H5_DATASET, 1, 1, use_cache=False)
+
+def benchmark_pressure_image_process(benchmark, data_root, track_memory):
+
+    h5_dataset = H5_DATASET(1, 1, use_cache=False)
+    track_memory(process_pressure_images, h5_dataset.pressure)
+    benchmark(process_pressure_images, h5_dataset.pressure)
+
+def benchmark_egocentric_labels(benchmark, data_root, track_memory):
+
+    def egocentric_labels():
+        h5_dataset = H5_DATASET(1, 1, use_cache=False)
+        return h5_dataset.egocentric_labels()
+
+    track_memory(egocentric_labels)
+    benchmark(egocentric_labels)
+
+@pytest.mark.parametrize('pose_id', [-1, 2])
+def benchmark_make_tensor(benchmark, data_root, track_memory, pose_id):
+
+    h5_dataset = H5_DATASET(1, 1)
+    h5_dataset.pressure_image_process()
+    h5_dataset.egocentric_labels()
+    track_memory(h5_dataset.make_tensor, WINDOW_LEN, pose_id)
+    data_tensor, label_tensor = benchmark(h5_dataset.make_tensor, WINDOW_LEN, pose_id)
+    benchmark.extra_info['windows'] = label_tensor.shape[0]
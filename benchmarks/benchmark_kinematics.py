@@ -0,0 +1,44 @@
+import h5py
+import numpy as np
+import pytest
+import torch
+from kinematics import INVERSE_KINEMATICS, FORWARD_KINEMATICS
+
+@pytest.fixture(scope='module')
+def session(data_root):
+    '''
+    Joints [N, 15, 3] and template [15, 3] of one synthetic session, z axis vertical.
+    '''
+    with h5py.File('./data_sample/participant1_section1.h5', 'r') as h5_file:
+        joints = h5_file['joint'][:][:, :, [0, 2, 1]]
+    template = np.load('./data_sample/template/template_1.npy')[:, [0, 2, 1]]
+    return (joints, template)
+
+def benchmark_inverse_kinematics_frame(benchmark, session):
+
+    joints, template = session
+    inverse_k_unit = INVERSE_KINEMATICS()
+    benchmark(inverse_k_unit.inverse_kinematics, joints[0], template)
+
+def benchmark_inverse_kinematics_batch(benchmark, session, track_memory):
+
+    joints, template = session
+    inverse_k_unit = INVERSE_KINEMATICS()
+    track_memory(inverse_k_unit.inverse_kinematics_batch, joints, template)
+    benchmark(inverse_k_unit.inverse_kinematics_batch, joints, template)
+    benchmark.extra_info['frames'] = joints.shape[0]
+
+@pytest.mark.parametrize('batch', [64, 1024])
+def benchmark_forward_kinematics_batch(benchmark, session, batch):
+
+    joints, template = session
+    forward_k_unit = FORWARD_KINEMATICS()
+    r6d = torch.randn(batch, 15, 6, generator=torch.Generator().manual_seed(0))
+    template = torch.tensor(template, dtype=torch.float32).expand(batch, 15, 3)
+
+    def forward_kinematics():
+        R_local = forward_k_unit.r6d_to_rotation_matrix(r6d)
+        R_global = forward_k_unit.forward_tree_batch(R_local, None)
+        return forward_k_unit.forward_kinematics_batch(R_global, template)
+
+    benchmark(forward_kinematics)
@@ -0,0 +1,58 @@
+import pytest
+import torch
+from loss_function import L2_LOSS, LC_LOSS, JOINT_LOSS
+from h5_dataset import make_template_table
+
+BATCH = 256
+
+@pytest.fixture(scope='module')
+def batch(data_root):
+    '''
+    r6d predictions [B, 90], labels [B, LABEL_SCHEMA.SIZE] (joints, subject, root rotation) and the template table.
+    '''
+    generator = torch.Generator().manual_seed(0)
+    template_table = torch.from_numpy(make_template_table([1]))
+    label = torch.cat([torch.randn(BATCH, 45, generator=generator) * 50,
+                       torch.ones(BATCH, 1),
+                       torch.eye(3).reshape(1, 9).expand(BATCH, 9)], dim=1)
+    pred = torch.randn(BATCH, 90, generator=generator)
+    return (pred, label, template_table)
+
+def forward_backward(loss_function, pred: torch.Tensor, label: torch.Tensor):
+
+    pred = pred.clone().requires_grad_(True)
+    loss = loss_function(pred, label)
+    loss = sum(term.sum() for term in loss) if isinstance(loss, tuple) else loss.sum()
+    loss.backward()
+    return pred.grad
+
+def saved_tensor_memory(loss_function, pred: torch.Tensor, label: torch.Tensor):
+    '''
+    MB of the tensors saved for backward by one forward pass, storages saved several times are counted once.
+    '''
+    storages = {}
+
+    def pack(tensor: torch.Tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    pred = pred.clone().requires_grad_(True)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss_function(pred, label)
+    return sum(storages.values()) / 2**20
+
+@pytest.mark.parametrize('loss_class', [L2_LOSS, LC_LOSS, JOINT_LOSS])
+def benchmark_loss_forward_backward(benchmark, batch, loss_class):
+
+    pred, label, template_table = batch
+    loss_function = loss_class(template_table=template_table)
+    benchmark.extra_info['saved_tensors_mb'] = saved_tensor_memory(loss_function, pred, label)
+    if(torch.cuda.is_available()):
+        loss_function = loss_function.cuda()
+        pred, label = pred.cuda(), label.cuda()
+        torch.cuda.reset_peak_memory_stats()
+        forward_backward(loss_function, pred, label)
+        benchmark.extra_info['cuda_peak_memory_mb'] = torch.cuda.max_memory_allocated() / 2**20
+    benchmark(forward_backward, loss_function, pred, label)
+    benchmark.extra_info['batch'] = BATCH
@@ -0,0 +1,30 @@
+import os
+import numpy as np
+import pytest
+from conftest import ROOT_DIR
+
+vtk = pytest.importorskip('vtk')
+from class_garment import SMART_GARMENT
+
+CONFIG_DIR = os.path.join(ROOT_DIR, 'visualization_demo', 'config')
+EXAMPLE_DIR = os.path.join(ROOT_DIR, 'visualization_demo', 'example')
+
+@pytest.fixture(scope='module')
+def smart_garment():
+    '''
+    Garment on the bundled mesh, colored with the first bundled example.
+    '''
+    garment = SMART_GARMENT(os.path.join(CONFIG_DIR, 'config.json'), os.path.join(CONFIG_DIR, '20230108_man_2.obj'))
+    garment.set_pressure_data(np.load(os.path.join(EXAMPLE_DIR, 'human-1-cloths.npy')),
+                              np.load(os.path.join(EXAMPLE_DIR, 'human-1-pants.npy')))
+    return garment
+
+def benchmark_get_phi_z_all_vertices(benchmark, smart_garment, track_memory):
+
+    track_memory(smart_garment.obj.get_phi_z_all_vertices)
+    benchmark(smart_garment.obj.get_phi_z_all_vertices)
+    benchmark.extra_info['vertices'] = smart_garment.obj.vertices.shape[0]
+
+def benchmark_make_vtk_scalar(benchmark, smart_garment):
+
+    benchmark(smart_garment.make_vtk_scalar)
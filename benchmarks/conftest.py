@@ -0,0 +1,89 @@
+import os
+import sys
+import tracemalloc
+import cv2
+import h5py
+import numpy as np
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'smart_garment_dataset'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'visualization_demo'))
+
+from kinematics import FORWARD_KINEMATICS
+
+'''
+Synthetic sessions with the .h5 layout of the dataset, so the benchmarks need no private data.
+participant{p}_section{s}.h5: 'joint' [N, 15, 3], 'pressure' [N, 2, 64, 32], 'posture' [N, ], 'person', 'gender', 'device'
+template/template_{p}.npy: [15, 3]
+The y axis of joints and templates is vertical, as in the recorded data.
+'''
+NUM_FRAME = 2000
+PARTICIPANTS = (1, 2)
+SECTIONS = (1, 2)
+WINDOW_LEN = 30
+
+def make_template(rng: np.random.Generator):
+
+    template = np.array([[0, 0, 0], [0, 50, 0], [0, 70, 0], [18, 48, 0], [-18, 48, 0],
+                         [20, 20, 0], [-20, 20, 0], [22, -5, 0], [-22, -5, 0],
+                         [10, -3, 0], [-10, -3, 0], [10, -45, 0], [-10, -45, 0], [10, -85, 0], [-10, -85, 0]],
+                        dtype=np.float64)
+    return template + rng.normal(0, 1, template.shape)
+
+def make_joints(rng: np.random.Generator, template: np.ndarray, num_frame: int):
+    '''
+    Joints [N, 15, 3] posed by random local rotations of the template.
+    '''
+    forward_k_unit = FORWARD_KINEMATICS()
+    template = template[:, [0, 2, 1]]
+    joints = np.empty((num_frame, 15, 3))
+    for n in range(num_frame):
+        R_local = np.array([cv2.Rodrigues(vec)[0] for vec in rng.normal(0, 0.3, (15, 3))])
+        R_global = forward_k_unit.forward_tree(R_local, None)
+        location = forward_k_unit.forward_kinematics(R_global, template).reshape(15, 3) + rng.normal(0, 1, 3)
+        joints[n] = location[:, [0, 2, 1]]
+    return joints
+
+def make_sessions(data_dir: str, num_frame: int = NUM_FRAME, seed: int = 0):
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(data_dir, 'template'), exist_ok=True)
+    for participant in PARTICIPANTS:
+        template = make_template(rng)
+        np.save(os.path.join(data_dir, 'template', f'template_{participant}.npy'), template)
+        for section in SECTIONS:
+            posture = np.repeat(rng.integers(0, 4, num_frame // 50 + 1), 50)[:num_frame]
+            with h5py.File(os.path.join(data_dir, f'participant{participant}_section{section}.h5'), 'w') as h5_file:
+                h5_file['joint'] = make_joints(rng, template, num_frame)
+                h5_file['pressure'] = rng.integers(0, 1200, (num_frame, 2, 64, 32)).astype(np.float32)
+                h5_file['posture'] = posture
+                h5_file['person'] = participant
+                h5_file['gender'] = 0
+                h5_file['device'] = 2
+
+@pytest.fixture(scope='session')
+def data_root(tmp_path_factory):
+    '''
+    Working directory holding ./data_sample, the dataset classes read their files relative to it.
+    '''
+    root = tmp_path_factory.mktemp('smart_garment')
+    make_sessions(os.path.join(root, 'data_sample'))
+    cwd = os.getcwd()
+    os.chdir(root)
+    yield root
+    os.chdir(cwd)
+
+@pytest.fixture
+def track_memory(benchmark):
+    '''
+    Run fn once under tracemalloc and record its peak memory in the benchmark JSON (extra_info['peak_memory_mb']).
+    tracemalloc sees numpy allocations, torch tensors are not traced.
+    '''
+    def track(fn, *args, **kwargs):
+        tracemalloc.start()
+        fn(*args, **kwargs)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        benchmark.extra_info['peak_memory_mb'] = peak / 2**20
+    return track
@@ -0,0 +1,170 @@
+import json
+import shutil
+import cv2
+import h5py
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+from conftest import WINDOW_LEN
+from h5_dataset import H5_DATASET, process_pressure_images, window_runs
+from dataset_store import DATASET_STORE, compile_dataset
+from torch_dataset import SMART_GARMENT_DATASET, make_data_loader
+from augmentation import PRESSURE_AUGMENTATION
+
+'''
+Equivalence of the vectorised pressure processing and of the in-memory, lazy and store datasets.
+'''
+GROUPING = [(1, 1), (1, 2), (2, 1)]
+
+@pytest.fixture(scope='module')
+def pressure(data_root):
+
+    with h5py.File('./data_sample/participant1_section1.h5', 'r') as h5_file:
+        return h5_file['pressure'][:200]
+
+@pytest.fixture(scope='module')
+def store_dir(data_root):
+
+    store_dir = str(data_root / 'store')
+    compile_dataset(GROUPING, store_dir, pressure_dtype='float32')
+    return store_dir
+
+def process_pressure_loop(pressure: np.ndarray):
+    '''
+    Image by image cutoff, clipping and blur with OpenCV.
+    '''
+    pressure = pressure.copy()
+    for i in range(pressure.shape[0]):
+        for j in range(pressure.shape[1]):
+            ret, img = cv2.threshold(pressure[i, j], 1024, 1024, cv2.THRESH_TOZERO_INV)
+            ret, img = cv2.threshold(img, 512, 512, cv2.THRESH_TRUNC)
+            pressure[i, j] = cv2.GaussianBlur(img, (3, 3), 0, 0)
+    return pressure
+
+@pytest.mark.parametrize('chunk_size', [None, 64])
+def test_process_pressure_images(pressure, chunk_size):
+
+    expected = process_pressure_loop(pressure)
+    np.testing.assert_allclose(process_pressure_images(pressure, chunk_size=chunk_size), expected, atol=1e-3)
+    inplace = pressure.copy()
+    process_pressure_images(inplace, out=inplace, chunk_size=chunk_size)
+    np.testing.assert_allclose(inplace, expected, atol=1e-3)
+
+@pytest.mark.parametrize('kwargs', [{}, {'pose_id': [1, 2]}, {'window_stride': 3, 'dilation': 2}])
+def test_dataset_modes(data_root, store_dir, kwargs):
+    '''
+    In-memory, lazy .h5 and store datasets return the same windows and labels.
+    '''
+    kwargs = dict({'pose_id': -1}, **kwargs)
+    datasets = [SMART_GARMENT_DATASET(GROUPING, WINDOW_LEN, **kwargs),
+                SMART_GARMENT_DATASET(GROUPING, WINDOW_LEN, lazy=True, **kwargs),
+                SMART_GARMENT_DATASET(GROUPING, WINDOW_LEN, store=store_dir, **kwargs)]
+    expected = datasets[0]
+    assert len(expected) > 0
+    indices = np.arange(0, len(expected), 97)
+    for dataset in datasets[1:]:
+        assert len(dataset) == len(expected)
+        torch.testing.assert_close(dataset.template_table, expected.template_table)
+        for index in indices:
+            for (value, expected_value) in zip(dataset[int(index)], expected[int(index)]):
+                torch.testing.assert_close(value, expected_value, atol=1e-4, rtol=1e-5)
+    for dataset in datasets:
+        pressure, label = dataset.get_batch(indices)
+        torch.testing.assert_close(pressure, torch.stack([dataset[int(index)][0] for index in indices]))
+        torch.testing.assert_close(label, torch.stack([dataset[int(index)][1] for index in indices]))
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_data_loader(data_root, lazy):
+    '''
+    A plain DataLoader and make_data_loader both yield batches of windows.
+    '''
+    dataset = SMART_GARMENT_DATASET(GROUPING[:1], WINDOW_LEN, -1, lazy=lazy)
+    pressure, label = next(iter(DataLoader(dataset, batch_size=8)))
+    assert pressure.shape == (8, WINDOW_LEN, 2, 64, 32)
+    torch.testing.assert_close(label, dataset.label_tensor[:8])
+    batch_pressure, batch_label = next(iter(make_data_loader(dataset, 8, shuffle=False)))
+    torch.testing.assert_close(batch_pressure, pressure)
+    torch.testing.assert_close(batch_label, label)
+
+@pytest.mark.parametrize('window_stride', [21, 30, 100])
+def test_window_stride_short_segments(data_root, window_stride):
+    '''
+    Segments with fewer windows than window_stride keep one window, random offsets keep windows in their segment.
+    '''
+    full = SMART_GARMENT_DATASET(GROUPING, WINDOW_LEN, [1, 2])
+    runs = window_runs(full.window_start)
+    expected = int(np.sum(-(-runs[:, 1] // window_stride)))
+    dataset = SMART_GARMENT_DATASET(GROUPING, WINDOW_LEN, [1, 2], window_stride=window_stride,
+                                    random_offset=True, seed=1)
+    assert len(dataset) == expected
+    for epoch in range(3):
+        dataset.set_epoch(epoch)
+        assert len(dataset) == expected
+        position = dataset.window_position(np.arange(len(dataset)))
+        run = np.searchsorted(runs[:, 0], position, side='right') - 1
+        assert np.all(position < runs[run, 0] + runs[run, 1])
+        assert np.array_equal(np.unique(run), np.arange(runs.shape[0]))
+        pressure, label = dataset.get_batch(np.arange(len(dataset)))
+        torch.testing.assert_close(label, full.label_tensor[torch.from_numpy(position)])
+
+    h5_dataset = H5_DATASET(1, 1)
+    h5_dataset.pressure_image_process()
+    h5_dataset.egocentric_labels()
+    data_tensor, label_tensor = h5_dataset.make_tensor(WINDOW_LEN, [1, 2], window_stride=window_stride)
+    window_start, label_npy = h5_dataset.make_window_index(WINDOW_LEN, [1, 2])
+    assert label_tensor.shape[0] == np.sum(-(-window_runs(window_start)[:, 1] // window_stride)) > 0
+
+def test_outdated_store(store_dir, tmp_path):
+
+    outdated_dir = tmp_path / 'outdated'
+    shutil.copytree(store_dir, outdated_dir)
+    with open(outdated_dir / 'manifest.json') as manifest_file:
+        manifest = json.load(manifest_file)
+    manifest['egocentric_cache_version'] -= 1
+    with open(outdated_dir / 'manifest.json', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    with pytest.raises(ValueError, match='compile the store again'):
+        DATASET_STORE(str(outdated_dir))
+
+def test_augmentation_after_decode(data_root):
+
+    dataset = SMART_GARMENT_DATASET(GROUPING[:1], WINDOW_LEN, -1, pressure_dtype='uint16', defer_normalize=True)
+    pressure, label = dataset.get_batch(np.arange(8))
+    augmentation = PRESSURE_AUGMENTATION(seed=0).train()
+    with pytest.raises(ValueError, match='decode_pressure'):
+        augmentation(pressure, label)
+    augmented, augmented_label = augmentation(dataset.decode_pressure(pressure), label)
+    assert augmented.dtype == torch.float32 and augmented.shape == pressure.shape
+
+@pytest.mark.parametrize('pose_id', [-1, 2, [1, 2], 9])
+def test_select_data_by_pose_lazy(data_root, pose_id):
+
+    h5_dataset = H5_DATASET(1, 1)
+    lazy_dataset = H5_DATASET(1, 1, lazy=True)
+    for (value, expected_value) in zip(lazy_dataset.select_data_by_pose(pose_id), h5_dataset.select_data_by_pose(pose_id)):
+        np.testing.assert_array_equal(value, expected_value)
+
+@pytest.mark.parametrize('num_replicas', [2, 5, 8])
+@pytest.mark.parametrize('mode', ['memory', 'lazy', 'store'])
+def test_shard_windows(data_root, store_dir, num_replicas, mode):
+    '''
+    Shards hold every window of the full dataset once, also with more ranks than sessions.
+    '''
+    kwargs = {'lazy': mode == 'lazy', 'store': store_dir if mode == 'store' else None}
+    full = SMART_GARMENT_DATASET(GROUPING, WINDOW_LEN, [1, 2], **kwargs)
+    shards = [SMART_GARMENT_DATASET(GROUPING, WINDOW_LEN, [1, 2], shard=True, rank=rank, num_replicas=num_replicas,
+                                    **kwargs) for rank in range(num_replicas)]
+    sizes = [len(shard) for shard in shards]
+    assert sum(sizes) == len(full) and min(sizes) > 0
+    assert max(sizes) <= 1.1 * len(full) / num_replicas + 1
+    label = np.concatenate([shard.label_tensor.numpy() for shard in shards])
+    order = np.lexsort(label.T)
+    expected_order = np.lexsort(full.label_tensor.numpy().T)
+    np.testing.assert_array_equal(label[order], full.label_tensor.numpy()[expected_order])
+
+    full_index = {full.label_tensor[i].numpy().tobytes(): i for i in range(len(full))}
+    for shard in shards:
+        for index in (0, len(shard) // 2, len(shard) - 1):
+            pressure, shard_label = shard[index]
+            torch.testing.assert_close(pressure, full[full_index[shard_label.numpy().tobytes()]][0])
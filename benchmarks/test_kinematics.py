@@ -0,0 +1,127 @@
+import h5py
+import numpy as np
+import pytest
+import torch
+from config import OPENPOSE_15_CONFIG
+from kinematics import INVERSE_KINEMATICS, FORWARD_KINEMATICS, FORWARD_KINEMATICS_LAYER
+
+'''
+Equivalence of the batched kinematics with the per-frame and per-joint implementations they replace.
+'''
+NUM_FRAME = 200
+
+@pytest.fixture(scope='module')
+def session(data_root):
+    '''
+    Joints [N, 15, 3] and template [15, 3] of the first frames of one synthetic session, z axis vertical.
+    '''
+    with h5py.File('./data_sample/participant1_section1.h5', 'r') as h5_file:
+        joints = h5_file['joint'][:NUM_FRAME][:, :, [0, 2, 1]]
+    template = np.load('./data_sample/template/template_1.npy')[:, [0, 2, 1]]
+    return (joints, template)
+
+def forward_tree_loop(R_local: torch.Tensor, R_root):
+    '''
+    Joint by joint forward tree, [B, 15, 3, 3].
+    '''
+    parent = OPENPOSE_15_CONFIG().PARENT
+    R_global = [R_local[:, 0] if R_root is None else torch.bmm(R_local[:, 0], R_root[:, 0])]
+    for i in range(1, len(parent)):
+        R_global.append(torch.bmm(R_global[parent[i]], R_local[:, i]))
+    return torch.stack(R_global, dim=1)
+
+def forward_kinematics_loop(R_global: torch.Tensor, template_location: torch.Tensor):
+    '''
+    Joint by joint forward kinematics, [B, 15, 3, 1].
+    '''
+    parent = OPENPOSE_15_CONFIG().PARENT
+    template_location = template_location.view(-1, 15, 3, 1)
+    joint_location = [torch.bmm(R_global[:, 0], template_location[:, 0])]
+    for i in range(1, len(parent)):
+        joint_location.append(torch.bmm(R_global[:, i], template_location[:, i] - template_location[:, parent[i]])
+                              + joint_location[parent[i]])
+    return torch.stack(joint_location, dim=1)
+
+def test_inverse_kinematics_batch(session):
+
+    joints, template = session
+    inverse_k_unit = INVERSE_KINEMATICS()
+    R_global, R_local = inverse_k_unit.inverse_kinematics_batch(joints, template)
+    for n in range(joints.shape[0]):
+        R_global_frame, R_local_frame = inverse_k_unit.inverse_kinematics(joints[n], template)
+        np.testing.assert_allclose(R_global[n], R_global_frame, atol=1e-6)
+        np.testing.assert_allclose(R_local[n], R_local_frame, atol=1e-6)
+
+def test_rodrigues_batch_opposite():
+
+    inverse_k_unit = INVERSE_KINEMATICS()
+    vec_before = np.array([[1.0, 0, 0], [0, 2.0, 0], [1.0, 2.0, 3.0], [1.0, 2.0, 3.0]])
+    vec_after = np.array([[-3.0, 0, 0], [0, -1.0, 0], [-1.0, -2.0, -3.0], [3.0, 1.0, 2.0]])
+    rotation_mat = inverse_k_unit.rodrigues_batch(vec_before, vec_after)
+    unit_after = vec_after / np.linalg.norm(vec_after, axis=-1, keepdims=True)
+    unit_turned = np.einsum('nij,nj->ni', rotation_mat, vec_before / np.linalg.norm(vec_before, axis=-1, keepdims=True))
+    np.testing.assert_allclose(unit_turned, unit_after, atol=1e-12)
+    np.testing.assert_allclose(np.linalg.det(rotation_mat), 1, atol=1e-12)
+
+def test_forward_kinematics_numpy(session):
+
+    joints, template = session
+    R_global, R_local = INVERSE_KINEMATICS().inverse_kinematics_batch(joints, template)
+    forward_k_unit = FORWARD_KINEMATICS()
+    R_local = torch.from_numpy(R_local)
+    R_root = torch.from_numpy(R_global[:, :1])
+    R_global_loop = forward_tree_loop(R_local, R_root).numpy()
+    location_loop = forward_kinematics_loop(torch.from_numpy(R_global_loop),
+                                            torch.from_numpy(template).expand(joints.shape[0], 15, 3)).numpy()
+    for n in range(joints.shape[0]):
+        R_global_frame = forward_k_unit.forward_tree(R_local[n].numpy(), R_root[n, 0].numpy())
+        np.testing.assert_allclose(R_global_frame, R_global_loop[n], atol=1e-10)
+        np.testing.assert_allclose(forward_k_unit.forward_kinematics(R_global_frame, template), location_loop[n],
+                                   atol=1e-8)
+
+@pytest.mark.parametrize('root', [False, True])
+def test_forward_kinematics_layer(session, root):
+
+    joints, template = session
+    R_global, R_local = INVERSE_KINEMATICS().inverse_kinematics_batch(joints, template)
+    R_local = torch.from_numpy(R_local).float()
+    R_root = torch.from_numpy(R_global[:, :1]).float() if root else None
+    template = torch.from_numpy(template).float().expand(joints.shape[0], 15, 3)
+    layer = FORWARD_KINEMATICS_LAYER()
+
+    R_global_loop = forward_tree_loop(R_local, R_root)
+    torch.testing.assert_close(layer.forward_tree(R_local, R_root), R_global_loop, atol=1e-5, rtol=1e-5)
+    torch.testing.assert_close(layer.forward_kinematics(R_global_loop, template),
+                               forward_kinematics_loop(R_global_loop, template), atol=1e-3, rtol=1e-5)
+
+def test_forward_kinematics_root_repeat():
+
+    generator = torch.Generator().manual_seed(0)
+    layer = FORWARD_KINEMATICS_LAYER()
+    r6d = torch.randn(8, 90, generator=generator)
+    template = torch.randn(8, 45, generator=generator)
+    R_root = torch.linalg.qr(torch.randn(16, 1, 3, 3, generator=generator))[0]
+    location = layer.r6d_forward_kinematics(r6d, template, R_root)
+    torch.testing.assert_close(location[:8], layer.r6d_forward_kinematics(r6d, template, R_root[:8]))
+    torch.testing.assert_close(location[8:], layer.r6d_forward_kinematics(r6d, template, R_root[8:]))
+    with pytest.raises(AssertionError):
+        layer.r6d_forward_kinematics(r6d, template, R_root[:12])
+
+@pytest.mark.parametrize('autocast', [False, True])
+def test_recomputed_backward(autocast):
+    '''
+    The recomputed backward gives the gradients of the stored one, also under bf16 autocast.
+    '''
+    generator = torch.Generator().manual_seed(0)
+    r6d = torch.randn(64, 90, generator=generator)
+    template = torch.randn(64, 45, generator=generator) * 50
+    R_root = torch.linalg.qr(torch.randn(64, 1, 3, 3, generator=generator))[0]
+    result = []
+    for recompute_backward in (True, False):
+        x = r6d.clone().requires_grad_(True)
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=autocast):
+            location = FORWARD_KINEMATICS_LAYER(recompute_backward)(x, template, R_root)
+        location.float().square().sum().backward()
+        result.append((location, x.grad))
+    torch.testing.assert_close(result[0][0], result[1][0])
+    torch.testing.assert_close(result[0][1], result[1][1])
@@ -0,0 +1,68 @@
+import pytest
+import torch
+from config import LABEL_SCHEMA
+from loss_function import L2_LOSS, LC_LOSS, JOINT_LOSS
+from h5_dataset import make_template_table
+
+'''
+Equivalence of the losses on LABEL_SCHEMA labels with a template table and on legacy labels.
+'''
+BATCH = 64
+
+@pytest.fixture(scope='module')
+def batch(data_root):
+    '''
+    r6d predictions [B, 90], LABEL_SCHEMA labels [B, 55], the same labels in the legacy layout [B, 99]
+    and the template table.
+    '''
+    generator = torch.Generator().manual_seed(0)
+    template_table = torch.from_numpy(make_template_table([1, 2]))
+    subject = torch.randint(1, 3, (BATCH, ), generator=generator)
+    joint = torch.randn(BATCH, 45, generator=generator) * 50
+    root_rotation = torch.linalg.qr(torch.randn(BATCH, 3, 3, generator=generator))[0].reshape(BATCH, 9)
+    label = torch.cat([joint, subject[:, None].float(), root_rotation], dim=1)
+    legacy_label = torch.cat([joint, template_table[subject].reshape(BATCH, 45), root_rotation], dim=1)
+    pred = torch.randn(BATCH, 90, generator=generator)
+    return (pred, label, legacy_label, template_table)
+
+def forward_backward(loss_function, pred: torch.Tensor, label: torch.Tensor):
+
+    pred = pred.clone().requires_grad_(True)
+    loss = loss_function(pred, label)
+    loss = loss if isinstance(loss, tuple) else (loss, )
+    sum(term.sum() for term in loss).backward()
+    return (loss, pred.grad)
+
+@pytest.mark.parametrize('loss_class', [L2_LOSS, LC_LOSS, JOINT_LOSS])
+def test_template_table_loss(batch, loss_class):
+
+    pred, label, legacy_label, template_table = batch
+    assert label.shape[1] == LABEL_SCHEMA().SIZE
+    loss, grad = forward_backward(loss_class(template_table=template_table), pred, label)
+    legacy_loss, legacy_grad = forward_backward(loss_class(), pred, legacy_label)
+    for (term, legacy_term) in zip(loss, legacy_loss):
+        torch.testing.assert_close(term, legacy_term)
+    torch.testing.assert_close(grad, legacy_grad)
+
+def test_scripted_joint_loss(batch):
+
+    pred, label, legacy_label, template_table = batch
+    loss = JOINT_LOSS(template_table=template_table)
+    for (term, scripted_term) in zip(loss(pred, label), torch.jit.script(loss)(pred, label)):
+        torch.testing.assert_close(term, scripted_term)
+
+@pytest.mark.parametrize('loss_class', [L2_LOSS, LC_LOSS, JOINT_LOSS])
+def test_schema_label_without_table(batch, loss_class):
+
+    pred, label, legacy_label, template_table = batch
+    with pytest.raises(ValueError, match='template_table'):
+        loss_class()(pred, label)
+
+@pytest.mark.parametrize('loss_class', [L2_LOSS, LC_LOSS, JOINT_LOSS])
+def test_autocast_loss(batch, loss_class):
+
+    pred, label, legacy_label, template_table = batch
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        loss, grad = forward_backward(loss_class(template_table=template_table), pred, label)
+    assert all(torch.isfinite(term).all() for term in loss)
+    assert torch.isfinite(grad).all()
@@ -0,0 +1,140 @@
+import torch
+from torch import nn
+from typing import Dict, Optional, Tuple
+from kinematics import axis_rotation_tensor
+from config import OPENPOSE_15_CONFIG, LABEL_SCHEMA
+
+class PRESSURE_AUGMENTATION(nn.Module):
+    '''
+    Batched augmentation of pressure windows [B, T, 2, 64, 32] and labels [B, LABEL_SCHEMA.SIZE]
+    (or legacy labels [B, 90], [B, 99] with root rotation).
+    Every random draw is one tensor operation over the whole batch on the device of the batch,
+    so the module runs after the DataLoader, e.g. right after moving a batch to the GPU.
+    Augmentation runs after decode_pressure: batches of defer_normalize datasets are decoded first
+    (SMART_GARMENT_DATASET.decode_pressure or DEVICE_PREFETCHER with decode), integer pressure raises ValueError.
+    Augmentation is applied in training mode only, eval mode keeps the data and only applies the temporal stride.
+    '''
+    def __init__(self, yaw_range: float = 0.0, stripe_dropout: float = 0.02, gain_range: float = 0.1,
+                 stride: int = 1, num_frame: Optional[int] = None, max_shift: int = 0, seed: Optional[int] = None):
+        '''
+        yaw_range: joints are rotated around the vertical axis by an angle in [-yaw_range, yaw_range],
+                   the subject (or template) columns stay unchanged and the root rotation is rotated along.
+                   Egocentric labels have no yaw, keep 0 unless the labels are in a global view.
+        stripe_dropout: probability of each sensing stripe (a row or column of one garment) being broken,
+                        broken stripes read 0 in all frames of the window.
+        gain_range: each garment of each sample is scaled by a gain in [1 - gain_range, 1 + gain_range].
+        stride, num_frame: num_frame frames taken every stride frames around the middle frame of the window,
+                           num_frame=None takes as many frames as the window allows.
+        max_shift: in training the taken frames are shifted together by up to max_shift frames.
+        seed: seed of the random generators, None draws from the global torch generator.
+        '''
+        super(PRESSURE_AUGMENTATION, self).__init__()
+        self.config = OPENPOSE_15_CONFIG()
+        self.schema = LABEL_SCHEMA()
+        self.yaw_range = yaw_range
+        self.stripe_dropout = stripe_dropout
+        self.gain_range = gain_range
+        self.stride = stride
+        self.num_frame = num_frame
+        self.max_shift = max_shift
+        self.seed = seed
+        self.generators: Dict[str, torch.Generator] = {}
+
+    def generator(self, device: torch.device):
+        '''
+        One generator per device, created from the seed on first use.
+        '''
+        if(self.seed is None):
+            return None
+        if(str(device) not in self.generators):
+            self.generators[str(device)] = torch.Generator(device=device)
+            self.generators[str(device)].manual_seed(self.seed)
+        return self.generators[str(device)]
+
+    def manual_seed(self, seed: int):
+        '''
+        Restart all generators from seed, e.g. at the beginning of an epoch.
+        '''
+        self.seed = seed
+        self.generators = {}
+
+    def uniform(self, shape: Tuple[int, ...], low: float, high: float, reference: torch.Tensor):
+        rand = torch.rand(shape, generator=self.generator(reference.device), device=reference.device,
+                          dtype=reference.dtype)
+        return low + (high - low) * rand
+
+    def frame_index(self, batch: int, window_len: int, device: torch.device):
+        '''
+        Frame index [B, num_frame] of the temporal crop, centred on the middle frame labelled by the window.
+        '''
+        num_frame = self.num_frame if self.num_frame is not None else (window_len - 1) // self.stride + 1
+        offset = (torch.arange(num_frame, device=device) - num_frame // 2) * self.stride + window_len // 2
+        if(int(offset[0]) < 0 or int(offset[-1]) >= window_len):
+            raise ValueError(f'{num_frame} frames with stride {self.stride} do not fit in windows of {window_len} frames.')
+        shift = torch.zeros((batch, 1), dtype=torch.long, device=device)
+        if(self.training and self.max_shift > 0):
+            low = max(-self.max_shift, -int(offset[0]))
+            high = min(self.max_shift, window_len - 1 - int(offset[-1]))
+            shift = torch.randint(low, high + 1, (batch, 1), generator=self.generator(device), device=device)
+        return offset[None, :] + shift
+
+    def temporal_crop(self, pressure: torch.Tensor):
+        batch, window_len = pressure.shape[0], pressure.shape[1]
+        if(self.stride == 1 and self.num_frame is None and self.max_shift == 0):
+            return pressure
+        frame_index = self.frame_index(batch, window_len, pressure.device)
+        batch_index = torch.arange(batch, device=pressure.device)[:, None]
+        return pressure[batch_index, frame_index]
+
+    def pressure_gain(self, pressure: torch.Tensor):
+        '''
+        Stripe dropout and gain jitter as one multiplier [B, 1, 2, 64, 32] broadcast over the frames.
+        '''
+        batch, num_garment, num_row, num_column = pressure.shape[0], pressure.shape[2], pressure.shape[3], pressure.shape[4]
+        gain = self.uniform((batch, 1, num_garment, 1, 1), 1 - self.gain_range, 1 + self.gain_range, pressure)
+        if(self.stripe_dropout > 0):
+            row = self.uniform((batch, 1, num_garment, num_row, 1), 0, 1, pressure) >= self.stripe_dropout
+            column = self.uniform((batch, 1, num_garment, 1, num_column), 0, 1, pressure) >= self.stripe_dropout
+            gain = gain * (row & column).to(pressure.dtype)
+        return pressure * gain
+
+    def rotate_label(self, label: torch.Tensor):
+        '''
+        Rotate joints and the root rotation (if present) around the vertical axis by a random yaw per sample.
+        Labels of LABEL_SCHEMA.SIZE columns follow the schema, other labels the legacy layout.
+        '''
+        batch = label.shape[0]
+        if(label.shape[1] == self.schema.SIZE):
+            root_start = self.schema.ROOT_ROTATION_START
+        elif(label.shape[1] >= self.schema.LEGACY_ROOT_ROTATION_END):
+            root_start = self.schema.LEGACY_ROOT_ROTATION_START
+        else:
+            root_start = -1
+        yaw = self.uniform((batch, ), -self.yaw_range, self.yaw_range, label)
+        R_yaw = axis_rotation_tensor(yaw, 'z')
+        label = label.clone()
+        joint = label[:, self.schema.JOINT_START: self.schema.JOINT_END].reshape(batch, -1, 3)
+        label[:, self.schema.JOINT_START: self.schema.JOINT_END] = \
+            torch.matmul(joint, R_yaw.transpose(1, 2)).reshape(batch, -1)
+        if(root_start >= 0):
+            root_rotation = label[:, root_start: root_start + 9].reshape(batch, 3, 3)
+            label[:, root_start: root_start + 9] = torch.matmul(R_yaw, root_rotation).reshape(batch, 9)
+        return label
+
+    def forward(self, pressure: torch.Tensor, label: torch.Tensor):
+        '''
+        pressure: [B, T, 2, 64, 32] pressure windows
+        label: [B, LABEL_SCHEMA.SIZE] (or legacy [B, 90], [B, 99]) labels of the windows
+        return: augmented (pressure, label), pressure in shape [B, num_frame, 2, 64, 32]
+        '''
+        pressure = self.temporal_crop(pressure)
+        if(not self.training):
+            return (pressure, label)
+        if(self.gain_range > 0 or self.stripe_dropout > 0):
+            if(not pressure.is_floating_point()):
+                raise ValueError(f'pressure of dtype {pressure.dtype} is not decoded, '
+                                 f'run decode_pressure before augmentation.')
+            pressure = self.pressure_gain(pressure)
+        if(self.yaw_range > 0):
+            label = self.rotate_label(label)
+        return (pressure, label)
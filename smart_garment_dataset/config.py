@@ -45,4 +45,25 @@ class OPENPOSE_15_CONFIG:
         self.NUM_LIMB = 14
 
         self.LIMB_COLOR = [None, 'red', 'red', 'yellow', 'orange', 'yellow', 'orange', 'yellow', 'orange', 'green', 'blue', 'green', 'blue', 'green', 'blue']
-        
\ No newline at end of file
+        
+class LABEL_SCHEMA:
+    '''
+    Column layout of window labels [K, SIZE].
+    JOINT: egocentric joint locations [15, 3] of the window centre
+    SUBJECT: participant id, the row of the subject's template in the template table
+    ROOT_ROTATION: root rotation [3, 3] without yaw of the window centre
+    Templates are not part of the labels, see make_template_table in h5_dataset.py.
+    The legacy layout carries a template copy in every label (LEGACY_TEMPLATE) and an optional root rotation (LEGACY_ROOT_ROTATION).
+    '''
+    def __init__(self):
+        self.JOINT_START = 0
+        self.JOINT_END = 45
+        self.SUBJECT = 45
+        self.ROOT_ROTATION_START = 46
+        self.ROOT_ROTATION_END = 55
+        self.SIZE = 55
+
+        self.LEGACY_TEMPLATE_START = 45
+        self.LEGACY_TEMPLATE_END = 90
+        self.LEGACY_ROOT_ROTATION_START = 90
+        self.LEGACY_ROOT_ROTATION_END = 99
@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+
+from h5_dataset import H5_DATASET, EGOCENTRIC_CACHE_VERSION, PRESSURE_CUTOFF, PRESSURE_MAX, PRESSURE_ENCODING, \
+    posture_segments, encode_pressure, pressure_to_tensor, decode_pressure
+
+'''
+Preprocessed dataset store, compiled once from the raw .h5 files and templates.
+store directory layout:
+'manifest.json': preprocessing parameters, pressure encoding and the session table
+'pressure.npy': [F, 2, 64, 32] preprocessed pressure of all sessions, encoded as 'pressure_dtype'
+'joint.npy': [F, 15, 3] float32 egocentric poses
+'root_rotation.npy': [F, 3, 3] float32 egocentric root rotations
+'posture.npy': [F, ] int16 pose identifier
+'template.npy': [P, 15, 3] float32 templates, row p belongs to manifest['participants'][p]
+'session.npy': [S, 4] int64 (participant, section, frame offset, frame number)
+F is the number of frames of all sessions, which are stored one after another.
+'''
+
+STORE_VERSION = 2
+
+def compile_dataset(grouping: list, store_dir: str, pressure_dtype: str = 'uint16', chunk_size: int = 4096):
+    '''
+    Compile the (participant, section) pairs in grouping into a store under store_dir.
+    Pressure is read and processed chunk by chunk and written straight into the memory mapped output.
+    '''
+    if(pressure_dtype not in PRESSURE_ENCODING):
+        raise ValueError(f"pressure_dtype must be one of {list(PRESSURE_ENCODING.keys())}.")
+    scale = PRESSURE_ENCODING[pressure_dtype]
+    time_start = time.perf_counter()
+    os.makedirs(store_dir, exist_ok=True)
+
+    sessions = [H5_DATASET(name, section, lazy=True) for (name, section) in grouping]
+    num_frame = [h5_dataset.pose_3d.shape[0] for h5_dataset in sessions]
+    frame_offset = np.concatenate([[0], np.cumsum(num_frame)]).astype(np.int64)
+
+    participants = sorted(set(name for (name, section) in grouping))
+    template = np.zeros((len(participants), 15, 3), dtype=np.float32)
+
+    pressure = np.lib.format.open_memmap(os.path.join(store_dir, 'pressure.npy'), mode='w+',
+                                         dtype=pressure_dtype, shape=(int(frame_offset[-1]), 2, 64, 32))
+    joint = np.lib.format.open_memmap(os.path.join(store_dir, 'joint.npy'), mode='w+',
+                                      dtype=np.float32, shape=(int(frame_offset[-1]), 15, 3))
+    root_rotation = np.lib.format.open_memmap(os.path.join(store_dir, 'root_rotation.npy'), mode='w+',
+                                              dtype=np.float32, shape=(int(frame_offset[-1]), 3, 3))
+    posture = np.empty(int(frame_offset[-1]), dtype=np.int16)
+
+    for i, h5_dataset in enumerate(sessions):
+        print(f'name: {h5_dataset.participant_id}, section: {h5_dataset.section_id}.')
+        h5_dataset.pressure_image_process()
+        offset = frame_offset[i]
+
+        for start in range(0, num_frame[i], chunk_size):
+            stop = min(start + chunk_size, num_frame[i])
+            encode_pressure(h5_dataset.read_pressure(start, stop), pressure_dtype,
+                            out=pressure[offset + start: offset + stop])
+
+        pose_egocentric, root_yaw, session_root_rotation = h5_dataset.egocentric_labels()
+        joint[offset: offset + num_frame[i]] = pose_egocentric
+        root_rotation[offset: offset + num_frame[i]] = session_root_rotation
+        posture[offset: offset + num_frame[i]] = h5_dataset.dataset['posture'][:]
+        template[participants.index(h5_dataset.participant_id)] = h5_dataset.template
+
+    pressure.flush()
+    joint.flush()
+    root_rotation.flush()
+    del pressure, joint, root_rotation
+    np.save(os.path.join(store_dir, 'posture.npy'), posture)
+    np.save(os.path.join(store_dir, 'template.npy'), template)
+    np.save(os.path.join(store_dir, 'session.npy'),
+            np.array([(name, section, frame_offset[i], num_frame[i]) for i, (name, section) in enumerate(grouping)],
+                     dtype=np.int64).reshape(-1, 4))
+
+    manifest = {
+        'store_version': STORE_VERSION,
+        'egocentric_cache_version': EGOCENTRIC_CACHE_VERSION,
+        'pressure_dtype': pressure_dtype,
+        'pressure_scale': scale,
+        'pressure_cutoff': PRESSURE_CUTOFF,
+        'pressure_max': PRESSURE_MAX,
+        'pressure_blur': 'gaussian 3x3, sigma 0, BORDER_REFLECT_101',
+        'joint_axis': 'x, z, y of the .h5 joint, z is vertical',
+        'num_frame': int(frame_offset[-1]),
+        'participants': participants,
+        'sessions': [{'participant': name, 'section': section,
+                      'offset': int(frame_offset[i]), 'frames': int(num_frame[i])}
+                     for i, (name, section) in enumerate(grouping)],
+    }
+    with open(os.path.join(store_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+    print(f'Compiled {len(grouping)} sessions, {frame_offset[-1]} frames in {time.perf_counter() - time_start:.2f}s.')
+    return manifest
+
+class DATASET_STORE:
+    '''
+    Read-only access to a compiled store, arrays are memory mapped and loaded on demand.
+    '''
+    def __init__(self, store_dir: str):
+
+        with open(os.path.join(store_dir, 'manifest.json')) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        if(self.manifest['store_version'] != STORE_VERSION):
+            raise ValueError(f"store version {self.manifest['store_version']} is not supported, "
+                             f"please compile the store again.")
+        if(self.manifest.get('egocentric_cache_version') != EGOCENTRIC_CACHE_VERSION):
+            raise ValueError(f"store labels of egocentric version {self.manifest.get('egocentric_cache_version')} "
+                             f"are outdated, please compile the store again.")
+
+        self.store_dir = store_dir
+        self.pressure = np.load(os.path.join(store_dir, 'pressure.npy'), mmap_mode='r')
+        self.joint = np.load(os.path.join(store_dir, 'joint.npy'), mmap_mode='r')
+        self.root_rotation = np.load(os.path.join(store_dir, 'root_rotation.npy'), mmap_mode='r')
+        self.posture = np.load(os.path.join(store_dir, 'posture.npy'), mmap_mode='r')
+        self.template = np.load(os.path.join(store_dir, 'template.npy'))
+        self.session = np.load(os.path.join(store_dir, 'session.npy'))
+        '''
+        normalized pressure = stored pressure * pressure_normalize
+        '''
+        self.pressure_dtype = self.manifest['pressure_dtype']
+        self.pressure_normalize = 1.0 / (self.manifest['pressure_scale'] * self.manifest['pressure_max'])
+        self.segments = {}
+
+    def session_frames(self, participant_id: int, section_id: int):
+        '''
+        Returns (frame offset, frame number) of a session in the store.
+        '''
+        index = np.where((self.session[:, 0] == participant_id) & (self.session[:, 1] == section_id))[0]
+        if(index.shape[0] == 0):
+            raise KeyError(f'participant {participant_id}, section {section_id} is not in store {self.store_dir}.')
+        return (int(self.session[index[0], 2]), int(self.session[index[0], 3]))
+
+    def session_segments(self, participant_id: int, section_id: int):
+        '''
+        Posture segments [S, 3] (pose id, start frame, stop frame) of a session, frames are relative to the session.
+        The index is built on first use and shared by all datasets created from this store.
+        '''
+        if((participant_id, section_id) not in self.segments):
+            offset, num_frame = self.session_frames(participant_id, section_id)
+            self.segments[(participant_id, section_id)] = posture_segments(self.posture[offset: offset + num_frame])
+        return self.segments[(participant_id, section_id)]
+
+    def participant_template(self, participant_id: int):
+        return self.template[self.manifest['participants'].index(participant_id)]
+
+    def template_table(self):
+        '''
+        Template table [max id + 1, 15, 3] of the participants in the store, see make_template_table.
+        '''
+        participants = self.manifest['participants']
+        table = np.zeros((max(participants) + 1 if participants else 0, 15, 3), dtype=np.float32)
+        table[participants] = self.template
+        return table
+
+    def read_pressure(self, frames: np.ndarray, decode: bool = True):
+        '''
+        Read store frames as a normalized float32 tensor, or as stored (see pressure_to_tensor) if decode is False.
+        Frames between the first and last frame are read as one chunk.
+        '''
+        pressure = self.pressure[frames[0]: frames[-1] + 1][frames - frames[0]]
+        if(not decode):
+            return pressure_to_tensor(pressure)
+        return decode_pressure(pressure_to_tensor(pressure), self.pressure_normalize)
+
+if __name__ == '__main__':
+    '''
+    python dataset_store.py [store_dir] [pressure_dtype] [participant:section] ...
+    '''
+    store_dir, pressure_dtype = sys.argv[1:3]
+    grouping = [tuple(int(value) for value in pair.split(':')) for pair in sys.argv[3:]]
+    compile_dataset(grouping, store_dir, pressure_dtype)
@@ -1,10 +1,13 @@
+import os
+import hashlib
 import h5py
 import torch
 import cv2
 import numpy as np
 
-from kinematics import INVERSE_KINEMATICS
-from config import OPENPOSE_15_CONFIG
+from kinematics import INVERSE_KINEMATICS, decompose_rotation, remove_yaw
+from config import OPENPOSE_15_CONFIG, LABEL_SCHEMA
+from profiling import DISABLED_PROFILER
 
 '''
 h5_dataset keys:
@@ -16,22 +19,297 @@ h5_dataset keys:
 'pressure': [N, 2, 64, 32] pressure data
 '''
 
+'''
+Version of the egocentric label computation, stored in the sidecar cache key.
+Increase it whenever turn_pose_egocentric or the kinematics it relies on changes.
+'''
+EGOCENTRIC_CACHE_VERSION = 3
+
+'''
+threshold 1024 is used to cut values caused by short-circuits.
+threshold 512 is used to limit pressure values, making it easier for normalization.
+'''
+PRESSURE_CUTOFF = 1024
+PRESSURE_MAX = 512
+
+'''
+Storage dtypes of processed pressure, stored pressure = processed pressure * PRESSURE_ENCODING[dtype].
+'uint16': processed values in 1/16 steps, 2 bytes per value. Lossless for integer raw data, since the 3x3 Gaussian
+          weights are multiples of 1/16, normalized values are bitwise equal to 'float32' after decode_pressure.
+'float16': normalized to [0, 1], 2 bytes per value, relative rounding error at most 2^-11.
+'float32': normalized to [0, 1], 4 bytes per value, the same values as dividing by 512.
+'''
+PRESSURE_ENCODING = {
+    'uint16': 16.0,
+    'float16': 1.0 / PRESSURE_MAX,
+    'float32': 1.0 / PRESSURE_MAX,
+}
+
+def gaussian_blur_axis(src: np.ndarray, dst: np.ndarray):
+    '''
+    3-tap Gaussian kernel [0.25, 0.5, 0.25] along the last axis of src, written into dst.
+    Borders are reflected without repeating the edge value, the same as cv2.BORDER_REFLECT_101.
+    '''
+    np.add(src[..., :-2], src[..., 2:], out=dst[..., 1:-1])
+    dst[..., 1:-1] += src[..., 1:-1]
+    dst[..., 1:-1] += src[..., 1:-1]
+    dst[..., 1:-1] *= 0.25
+    np.add(src[..., 0], src[..., 1], out=dst[..., 0])
+    dst[..., 0] *= 0.5
+    np.add(src[..., -1], src[..., -2], out=dst[..., -1])
+    dst[..., -1] *= 0.5
+    return dst
+
+def process_pressure_images(pressure, out: np.ndarray = None, chunk_size: int = None):
+    '''
+    Process pressure images [N, 2, 64, 32] as whole arrays: short-circuit cutoff, clipping and 3x3 Gaussian blur.
+    pressure can be an ndarray or any sliceable array such as an h5py dataset or a memmap.
+    out receives the float32 result, passing a float32 pressure array as out processes it in place.
+    chunk_size limits the number of frames processed at once for sessions larger than memory.
+    '''
+    num_frame = pressure.shape[0]
+    inplace = out is pressure
+    if(out is None):
+        out = np.empty(pressure.shape, dtype=np.float32)
+    if(chunk_size is None):
+        chunk_size = max(num_frame, 1)
+
+    for start in range(0, num_frame, chunk_size):
+        stop = min(start + chunk_size, num_frame)
+        images = out[start:stop]
+        if(not inplace):
+            images[...] = pressure[start:stop]
+        '''
+        All images of the chunk are stacked into one [n * 2 * 64, 32] image, so each OpenCV call covers the chunk.
+        '''
+        stacked = images.reshape(-1, images.shape[-1])
+        cv2.threshold(stacked, PRESSURE_CUTOFF, PRESSURE_CUTOFF, cv2.THRESH_TOZERO_INV, dst=stacked)
+        cv2.threshold(stacked, PRESSURE_MAX, PRESSURE_MAX, cv2.THRESH_TRUNC, dst=stacked)
+        '''
+        Gaussian filer is used to recover 0-values caused by broken-circuits.
+        The vertical pass of the stacked blur mixes neighbouring images at their first and last rows,
+        these rows are recomputed separately from the rows next to them.
+        '''
+        edge_rows = images[:, :, [0, 1, -2, -1]]
+        gaussian_blur_axis(edge_rows.copy(), edge_rows)
+        cv2.GaussianBlur(stacked, (3, 3), 0, dst=stacked)
+        np.add(edge_rows[:, :, 0], edge_rows[:, :, 1], out=images[:, :, 0])
+        images[:, :, 0] *= 0.5
+        np.add(edge_rows[:, :, 3], edge_rows[:, :, 2], out=images[:, :, -1])
+        images[:, :, -1] *= 0.5
+    return out
+
+def h5_path(participant_id: int, section_id: int):
+    return f'./data_sample/participant{participant_id}_section{section_id}.h5'
+
+def session_posture_segments(participant_id: int, section_id: int):
+    '''
+    Posture segments [S, 3] (see posture_segments) and number of frames of a session,
+    read from the .h5 posture labels without loading joints or pressure.
+    '''
+    with h5py.File(h5_path(participant_id, section_id), 'r') as h5_file:
+        posture = h5_file['posture'][:]
+    return (posture_segments(posture), posture.shape[0])
+
+def encode_pressure(pressure: np.ndarray, pressure_dtype: str, out: np.ndarray = None):
+    '''
+    Encode processed pressure (see process_pressure_images) as pressure_dtype, into out if it is given.
+    '''
+    if(pressure_dtype not in PRESSURE_ENCODING):
+        raise ValueError(f"pressure_dtype must be one of {list(PRESSURE_ENCODING.keys())}.")
+    if(out is None):
+        out = np.empty(pressure.shape, dtype=pressure_dtype)
+    scaled = np.multiply(pressure, PRESSURE_ENCODING[pressure_dtype], dtype=np.float32)
+    if(pressure_dtype == 'uint16'):
+        np.rint(scaled, out=scaled)
+    out[...] = scaled
+    return out
+
+def pressure_normalize(pressure_dtype: str):
+    '''
+    Factor turning stored pressure of pressure_dtype into pressure normalized to [0, 1].
+    '''
+    return 1.0 / (PRESSURE_ENCODING[pressure_dtype] * PRESSURE_MAX)
+
+def pressure_to_tensor(pressure: np.ndarray):
+    '''
+    Wrap stored pressure as a tensor without copying.
+    uint16 arrays are viewed as int16, which every torch version supports, stored values never exceed 512 * 16.
+    '''
+    if(pressure.dtype == np.uint16):
+        pressure = pressure.view(np.int16)
+    return torch.from_numpy(pressure)
+
+def decode_pressure(pressure: torch.Tensor, normalize: float):
+    '''
+    Normalized float32 pressure from stored pressure, best run on the training device after the batch is moved there.
+    Float32 pressure is already normalized and returned as it is.
+    '''
+    if(pressure.dtype == torch.float32):
+        return pressure
+    return pressure.to(torch.float32).mul_(normalize)
+
+def posture_segments(posture: np.ndarray):
+    '''
+    Run-length index [S, 3] of the posture labels of a session, one (pose id, start frame, stop frame) row
+    for every bout of consecutive frames with the same pose.
+    '''
+    posture = np.asarray(posture)
+    if(posture.shape[0] == 0):
+        return np.zeros((0, 3), dtype=np.int64)
+    change = np.flatnonzero(posture[1:] != posture[:-1]) + 1
+    start = np.concatenate([[0], change]).astype(np.int64)
+    stop = np.concatenate([change, [posture.shape[0]]]).astype(np.int64)
+    return np.stack([posture[start].astype(np.int64), start, stop], axis=1)
+
+def select_segments(segments: np.ndarray, pose_id, num_frame: int):
+    '''
+    Segments of one pose id or a list of pose ids.
+    pose_id = -1 selects the whole session as one segment, windows then run across posture changes.
+    '''
+    if(np.isscalar(pose_id) and pose_id == -1):
+        return np.array([[-1, 0, num_frame]], dtype=np.int64)
+    return segments[np.isin(segments[:, 0], pose_id)]
+
+def segment_windows(segments: np.ndarray, window_len: int):
+    '''
+    Start frames of all windows lying inside one segment, a segment of n frames holds n - window_len windows.
+    For dilated windows window_len is the span of the window (see window_span).
+    '''
+    num_window = np.maximum(segments[:, 2] - segments[:, 1] - window_len, 0)
+    first_window = np.concatenate([[0], np.cumsum(num_window)[:-1]]).astype(np.int64)
+    return np.repeat(segments[:, 1] - first_window, num_window) + np.arange(int(num_window.sum()), dtype=np.int64)
+
+def clip_segments(segments: np.ndarray, window_range, window_len: int):
+    '''
+    Segments cut to the windows starting at frames [start, stop) of window_range, None keeps all windows.
+    The frames after stop which the last windows cover are kept, window_len is the span of a window.
+    '''
+    if(window_range is None):
+        return segments
+    start, stop = window_range
+    segments = segments.copy()
+    segments[:, 1] = np.maximum(segments[:, 1], start)
+    segments[:, 2] = np.minimum(segments[:, 2], stop + window_len)
+    return segments[segments[:, 2] > segments[:, 1]]
+
+def window_span(window_len: int, dilation: int = 1):
+    '''
+    Frames covered by a window of window_len frames taken every dilation frames.
+    '''
+    return (window_len - 1) * dilation + 1
+
+def window_runs(window_start: np.ndarray, window_session: np.ndarray = None):
+    '''
+    Runs [R, 2] (first window, number of windows) of windows with consecutive start frames,
+    i.e. the windows of one posture segment. Windows of different sessions never share a run.
+    '''
+    if(window_start.shape[0] == 0):
+        return np.zeros((0, 2), dtype=np.int64)
+    run_break = np.diff(window_start) != 1
+    if(window_session is not None):
+        run_break = run_break | (np.diff(window_session) != 0)
+    first = np.concatenate([[0], np.flatnonzero(run_break) + 1]).astype(np.int64)
+    return np.stack([first, np.diff(np.append(first, window_start.shape[0]))], axis=1)
+
+def load_template(participant_id: int):
+    '''
+    Template [15, 3] of a participant, y and z axis transferred as the joints of H5_DATASET.
+    '''
+    return np.load(f'./data_sample/template/template_{participant_id}.npy')[:, [0, 2, 1]]
+
+def make_template_table(participant_ids):
+    '''
+    Template table [max id + 1, 15, 3] float32, row p holds the template of participant p and unused rows are zero.
+    Labels refer to their template by the participant id in column LABEL_SCHEMA.SUBJECT.
+    '''
+    participant_ids = sorted(set(int(participant_id) for participant_id in participant_ids))
+    table = np.zeros((participant_ids[-1] + 1 if participant_ids else 0, 15, 3), dtype=np.float32)
+    for participant_id in participant_ids:
+        table[participant_id] = load_template(participant_id)
+    return table
+
+def make_window_label(pose_egocentric: np.ndarray, root_rotation: np.ndarray, participant_id: int,
+                      window_start: np.ndarray, window_len: int, dilation: int = 1):
+    '''
+    Labels [num_window, LABEL_SCHEMA.SIZE] of windows starting at frames window_start of egocentric poses [N, 15, 3]
+    and root rotations [N, 3, 3]. The label of each window holds the egocentric pose and root rotation of its middle
+    frame and the participant id, the middle frame of a dilated window is its (window_len // 2)-th taken frame.
+    '''
+    schema = LABEL_SCHEMA()
+    num_window = window_start.shape[0]
+    if(num_window == 0):
+        return np.zeros((0, schema.SIZE), dtype=np.float32)
+    centre = window_start + (window_len//2) * dilation
+    label_npy = np.empty((num_window, schema.SIZE), dtype=np.float32)
+    label_npy[:, schema.JOINT_START: schema.JOINT_END] = pose_egocentric[centre].reshape(num_window, -1)
+    label_npy[:, schema.SUBJECT] = participant_id
+    label_npy[:, schema.ROOT_ROTATION_START: schema.ROOT_ROTATION_END] = root_rotation[centre].reshape(num_window, -1)
+
+    return label_npy
+
 class H5_DATASET:
     '''
     The class is designed to access .h5 dataset.
     '''
-    def __init__(self, participant_id: int, section_id: int):
-
+    def __init__(self, participant_id: int, section_id: int, use_cache: bool = True, lazy: bool = False,
+                 profiler = DISABLED_PROFILER):
+        '''
+        use_cache decides whether egocentric labels are read from / written to the sidecar cache
+        under ./data_sample/cache.
+        lazy keeps pressure data in the .h5 file, frames are read and processed on demand by read_pressure.
+        profiler is a STAGE_PROFILER timing the stages of the session (see profiling.py).
+        '''
+        self.profiler = profiler
         self.config = OPENPOSE_15_CONFIG()
-        self.inverse_k_unit = INVERSE_KINEMATICS(self.config)
-        self.dataset = h5py.File(f'./data_sample/participant{participant_id}_section{section_id}.h5', 'r')
+        self.inverse_k_unit = INVERSE_KINEMATICS()
+        self.participant_id = participant_id
+        self.section_id = section_id
+        self.use_cache = use_cache
+        self.lazy = lazy
+        self.h5_path = h5_path(participant_id, section_id)
+        self.cache_path = f'./data_sample/cache/participant{participant_id}_section{section_id}_egocentric.npz'
+        self.h5_file = None
+        self.h5_file_pid = None
+        with self.profiler.stage('h5_open'):
+            self.dataset
         '''
         Slices [0, 2, 1] is used to transfer y and z axis, after which z axis represent the actual vertical direction
         This procedure makes the following view changing easier.
         '''
-        self.pose_3d = self.dataset['joint'][:][:, :, [0, 2, 1]]
-        self.pressure = self.dataset['pressure'][:]
-        self.template = np.load(f'./data_sample/template/template_{participant_id}.npy')[:, [0, 2, 1]]
+        with self.profiler.stage('h5_read_joint'):
+            self.pose_3d = self.dataset['joint'][:][:, :, [0, 2, 1]]
+        self.profiler.count('bytes_read', self.pose_3d.nbytes)
+        self.pressure = None
+        if(not lazy):
+            with self.profiler.stage('h5_read_pressure'):
+                self.pressure = self.dataset['pressure'][:]
+            self.profiler.count('bytes_read', self.pressure.nbytes)
+        self.process_on_read = False
+        self.template = load_template(participant_id)
+        self.pose_egocentric = None
+        self.root_yaw = None
+        self.root_rotation = None
+        self.segments = None
+
+    @property
+    def dataset(self):
+        '''
+        The open .h5 file, opened on first access in every process.
+        h5py handles are neither shared across fork nor picklable, so the handle is reopened after fork
+        and dropped when the instance is pickled, e.g. for DataLoader workers started by spawn or forkserver.
+        '''
+        if(self.h5_file is None or self.h5_file_pid != os.getpid()):
+            self.h5_file = h5py.File(self.h5_path, 'r')
+            self.h5_file_pid = os.getpid()
+        return self.h5_file
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['h5_file'] = None
+        state['h5_file_pid'] = None
+        return state
 
     def turn_pose_egocentric(self, pose_3d: np.ndarray):
         '''
@@ -42,65 +320,200 @@ class H5_DATASET:
         R_z, R_y, R_x = self.inverse_k_unit.decomposite_rotation_matrix(R_global[0])
 
         return np.dot(np.linalg.inv(R_z), pose_3d.T).T
+
+    def cache_key(self):
+        '''
+        Key of the egocentric sidecar cache, built from the .h5 file, the template and the code version.
+        '''
+        h5_stat = os.stat(self.h5_path)
+        key = hashlib.sha1()
+        key.update(f'{EGOCENTRIC_CACHE_VERSION}|{os.path.abspath(self.h5_path)}|{h5_stat.st_size}|{h5_stat.st_mtime_ns}'.encode())
+        key.update(np.ascontiguousarray(self.template, dtype=np.float64).tobytes())
+        return key.hexdigest()
+
+    def egocentric_labels(self):
+        '''
+        Egocentric poses [N, 15, 3], root yaw R_z [N, 3, 3] and egocentric root rotation R_z^T R_root [N, 3, 3]
+        of every frame in the session.
+        Results are computed once over all frames and kept in memory and in the sidecar cache.
+        '''
+        if(self.pose_egocentric is not None):
+            return (self.pose_egocentric, self.root_yaw, self.root_rotation)
+
+        key = self.cache_key() if self.use_cache else None
+        if(self.use_cache and os.path.exists(self.cache_path)):
+            with np.load(self.cache_path) as cache:
+                if(str(cache['key']) == key):
+                    self.pose_egocentric = cache['pose_egocentric']
+                    self.root_yaw = cache['root_yaw']
+                    self.root_rotation = cache['root_rotation']
+                    self.profiler.count('egocentric_cache_hit')
+                    return (self.pose_egocentric, self.root_yaw, self.root_rotation)
+
+        with self.profiler.stage('egocentric_labels', frames=self.pose_3d.shape[0]):
+            R_global, R_local = self.inverse_k_unit.inverse_kinematics_batch(self.pose_3d, self.template)
+            yaw, pitch, roll, R_z, R_y, R_x = decompose_rotation(R_global[:, 0])
+            self.pose_egocentric = remove_yaw(self.pose_3d, R_z)
+            self.root_yaw = R_z
+            self.root_rotation = np.matmul(np.swapaxes(R_z, -1, -2), R_global[:, 0])
+
+        if(self.use_cache):
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            temp_path = f'{self.cache_path[:-len(".npz")]}.{os.getpid()}.tmp.npz'
+            np.savez(temp_path, key=key, pose_egocentric=self.pose_egocentric, root_yaw=self.root_yaw,
+                     root_rotation=self.root_rotation)
+            os.replace(temp_path, self.cache_path)
+        return (self.pose_egocentric, self.root_yaw, self.root_rotation)
     
     def pressure_image_process(self):
         '''
         Process all pressure images in the dataset. The function limits pressure values and smoothes the images.
+        In lazy mode images are processed chunk by chunk when read_pressure loads them.
         '''
-        for i in range(self.pressure.shape[0]):
-            img_front = self.pressure[i,0]
-            img_back = self.pressure[i,1]
-            '''
-            threshold 1024 is used to cut values caused by short-circuits.
-            threshold 512 is used to limit pressure values, making it easier for normalization.
-            '''
-            ret, img_front = cv2.threshold(img_front, 1024, 1024, cv2.THRESH_TOZERO_INV)
-            ret, img_front = cv2.threshold(img_front, 512, 512, cv2.THRESH_TRUNC)
-            img_front = cv2.GaussianBlur(img_front, (3, 3), 0, 0)
-
-            ret, img_back = cv2.threshold(img_back, 1024, 1024, cv2.THRESH_TOZERO_INV)
-            ret, img_back = cv2.threshold(img_back, 512, 512, cv2.THRESH_TRUNC)
-            '''
-            Gaussian filer is used to recover 0-values caused by broken-circuits.
-            '''
-            img_back = cv2.GaussianBlur(img_back, (3, 3), 0, 0)
-            
-            self.pressure[i] = np.array([img_front, img_back])[:]
+        if(self.lazy):
+            self.process_on_read = True
+            return
+        with self.profiler.stage('pressure_image_process', frames=self.pressure.shape[0]):
+            self.pressure = self.process_pressure_images(self.pressure)
+        self.profiler.count('frames_processed', self.pressure.shape[0])
         return
+
+    def process_pressure_images(self, pressure: np.ndarray):
+        '''
+        Process pressure images [N, 2, 64, 32], float32 arrays are processed in place.
+        '''
+        return process_pressure_images(pressure, out=pressure if pressure.dtype == np.float32 else None)
+
+    def read_pressure(self, start: int, stop: int):
+        '''
+        Read pressure frames [start, stop). In lazy mode the frames are sliced straight from the .h5 dataset,
+        see dataset for the use in DataLoader workers.
+        '''
+        if(not self.lazy):
+            return self.pressure[start:stop]
+
+        with self.profiler.stage('h5_read_pressure'):
+            pressure = self.dataset['pressure'][start:stop]
+        self.profiler.count('bytes_read', pressure.nbytes)
+        if(self.process_on_read):
+            with self.profiler.stage('pressure_image_process', frames=pressure.shape[0]):
+                pressure = self.process_pressure_images(pressure)
+            self.profiler.count('frames_processed', pressure.shape[0])
+        return pressure
     
-    def select_data_by_pose(self, pose_id:int):
+    def posture_index(self):
+        '''
+        Posture segments [S, 3] (pose id, start frame, stop frame) of the session, read from the .h5 file once.
+        '''
+        if(self.segments is None):
+            with self.profiler.stage('posture_index'):
+                self.segments = posture_segments(self.dataset['posture'][:])
+        return self.segments
+
+    def select_data_by_pose(self, pose_id):
         '''
-        Select pressure data and pose labels of a certian pose.
+        Select pressure data and pose labels of a certian pose or a list of poses.
         Inputing pose_id = -1 will return all poses.
+        In lazy mode the pressure of the selected segments is read by read_pressure.
         '''
-        posture_value = self.dataset['posture'][:]
+        with self.profiler.stage('select_data_by_pose'):
+            index = self.select_index_by_pose(pose_id)
+            if(not self.lazy):
+                return (self.pressure[index][:], self.pose_3d[index][:])
+            segments = select_segments(self.posture_index(), pose_id, self.pose_3d.shape[0])
+            pressure = [self.read_pressure(start, stop) for (pose, start, stop) in segments]
+            return (np.concatenate(pressure or [self.read_pressure(0, 0)]), self.pose_3d[index][:])
 
-        if(pose_id == -1):
-            return (self.pressure[:], self.pose_3d[:])
-        
-        index = np.where(posture_value == pose_id)[0]
-        return (self.pressure[index][:], self.pose_3d[index][:])
-    
-    def make_tensor(self, window_len:int, pose_id:int):
+    def select_index_by_pose(self, pose_id):
+        '''
+        Frame index of a certian pose or a list of poses. Inputing pose_id = -1 will return a slice over all frames.
+        '''
+        if(np.isscalar(pose_id) and pose_id == -1):
+            return slice(None)
+
+        segments = select_segments(self.posture_index(), pose_id, self.pose_3d.shape[0])
+        return np.concatenate([np.arange(start, stop) for (pose, start, stop) in segments] + [np.zeros(0, dtype=np.int64)])
+
+    def make_buffer(self, window_len:int, pose_id, pressure_dtype:str = 'float32', dilation:int = 1,
+                    window_range:tuple = None):
+        '''
+        Package a single contiguous pressure buffer of a certain pose together with window labels.
+        The buffer holds the segments of the pose which are long enough for a window, one after another,
+        windows never cross the boundary of a segment and no pressure frame is stored twice.
+        Returns (pressure buffer, window labels, buffer frame each window starts at).
+        The pressure data is stored as pressure_dtype (see PRESSURE_ENCODING), 'float32' is normalized to [0, 1]
+        by being divided by max-value 512.
+        A window with dilation takes window_len frames every dilation frames.
+        window_range (start, stop) keeps the windows starting at frames [start, stop) (see clip_segments).
+        '''
+        span = window_span(window_len, dilation)
+        segments = clip_segments(select_segments(self.posture_index(), pose_id, self.pose_3d.shape[0]), window_range,
+                                 span)
+        segments = segments[segments[:, 2] - segments[:, 1] > span]
+        window_start = segment_windows(segments, span)
+        label_npy = self.make_label(window_len, window_start, dilation)
+
+        num_frame = segments[:, 2] - segments[:, 1]
+        buffer_start = np.concatenate([[0], np.cumsum(num_frame)]).astype(np.int64)
+        with self.profiler.stage('window_materialisation', frames=int(buffer_start[-1])):
+            pressure_buffer = np.empty((int(buffer_start[-1]), 2, 64, 32), dtype=pressure_dtype)
+            for k, (pose, start, stop) in enumerate(segments):
+                encode_pressure(self.read_pressure(start, stop), pressure_dtype,
+                                out=pressure_buffer[buffer_start[k]: buffer_start[k + 1]])
+        buffer_segments = np.stack([segments[:, 0], buffer_start[:-1], buffer_start[1:]], axis=1)
+
+        return (pressure_buffer, label_npy, segment_windows(buffer_segments, span))
+
+    def make_window_index(self, window_len:int, pose_id, dilation:int = 1, window_range:tuple = None):
+        '''
+        Index windows of a certain pose without reading pressure data.
+        Returns the .h5 frame every window starts at and the window labels,
+        window k takes the frames window_start[k] + dilation * [0, window_len).
+        window_range (start, stop) keeps the windows starting at frames [start, stop) (see clip_segments).
+        '''
+        span = window_span(window_len, dilation)
+        segments = clip_segments(select_segments(self.posture_index(), pose_id, self.pose_3d.shape[0]), window_range,
+                                 span)
+        window_start = segment_windows(segments, span)
+        label_npy = self.make_label(window_len, window_start, dilation)
+
+        return (window_start, label_npy)
+
+    def make_label(self, window_len:int, window_start:np.ndarray, dilation:int = 1):
+        '''
+        Labels of the windows starting at .h5 frames window_start.
+        '''
+        pose_egocentric, root_yaw, root_rotation = self.egocentric_labels()
+        with self.profiler.stage('window_labels', windows=window_start.shape[0]):
+            return make_window_label(pose_egocentric, root_rotation, self.participant_id, window_start, window_len,
+                                     dilation)
+
+    def make_tensor(self, window_len:int, pose_id:int, pressure_dtype:str = 'float32', dilation:int = 1,
+                    window_stride:int = 1):
         '''
         Package tensor dataset of a certain pose for model training and validation.
-        The pressure data will be normalized to [0, 1] by being divided by max-value 512.
-        '''
-        data_npy = []
-        label_npy = []
-
-        data, label = self.select_data_by_pose(pose_id)
-        index = 0
-        while(index + window_len < data.shape[0]):
-            data_npy.append(data[index: index + window_len])
-            label_npy.append(np.concatenate([self.turn_pose_egocentric(label[index + window_len//2]).flatten(), 
-                                             self.template.flatten()]))
-            index = index + 1
-        
-        data_npy = np.array(data_npy) / 512
-        label_npy = np.array(label_npy)
-
-        data_tensor = torch.tensor(data_npy).float()
-        label_tensor = torch.tensor(label_npy).float()
+        Pressure is kept as pressure_dtype, see decode_pressure for normalizing batches.
+        The data tensor is a stride-based view [num_window, window_len, 2, 64, 32] on the buffer of make_buffer,
+        overlapping windows share memory and should not be modified in place.
+        Windows take a frame every dilation frames, and every window_stride-th window of a segment is kept,
+        starting at its first window, so a segment keeps ceil(windows / window_stride) windows.
+        When the pose has several segments, windows are gathered from the view into a new tensor.
+        '''
+        pressure_buffer, label_npy, window_start = self.make_buffer(window_len, pose_id, pressure_dtype, dilation)
+        runs = window_runs(window_start)
+        position = np.concatenate([first + np.arange(0, count, window_stride)
+                                   for (first, count) in runs] + [np.zeros(0, dtype=np.int64)])
+        window_start = window_start[position]
+
+        pressure_tensor = pressure_to_tensor(pressure_buffer)
+        num_position = max(pressure_tensor.shape[0] - window_span(window_len, dilation) + 1, 0)
+        data_tensor = pressure_tensor.as_strided((num_position, window_len) + tuple(pressure_tensor.shape[1:]),
+                                                 (pressure_tensor.stride(0), dilation * pressure_tensor.stride(0))
+                                                 + pressure_tensor.stride()[1:])
+        if(np.array_equal(window_start, np.arange(window_start.shape[0]))):
+            data_tensor = data_tensor[:window_start.shape[0]]
+        else:
+            data_tensor = data_tensor[torch.from_numpy(window_start)]
+        label_tensor = torch.from_numpy(label_npy[position])
 
         return (data_tensor, label_tensor)
@@ -2,8 +2,112 @@ import torch
 import cv2
 import math
 import numpy as np
+from torch import nn
+from typing import List, Optional
 from config import OPENPOSE_15_CONFIG
 
+def kinematic_levels(parent: list):
+    '''
+    INPUT:     Parent list of the kinematic tree, None for the root
+    OUTPUT:    Joints grouped by depth, a list of (joint index, parent index) pairs from depth 1 downwards
+    ATTENTION: Every joint of a level only depends on joints of former levels
+    '''
+    depth = [0] * len(parent)
+    for i in range(len(parent)):
+        k = i
+        while(parent[k] is not None):
+            depth[i] = depth[i] + 1
+            k = parent[k]
+
+    levels = []
+    for d in range(1, max(depth) + 1):
+        joints = [i for i in range(len(parent)) if depth[i] == d]
+        levels.append((joints, [parent[i] for i in joints]))
+    return levels
+
+def kinematic_ancestors(parent: list):
+    '''
+    INPUT:     Parent list of the kinematic tree, None for the root
+    OUTPUT:    [J, J] matrix A, A[i, k] = 1 if joint k is joint i or one of its ancestors
+    ATTENTION: Joint locations are A applied to the rotated bone vectors
+    '''
+    ancestors = np.zeros((len(parent), len(parent)))
+    for i in range(len(parent)):
+        k = i
+        while(k is not None):
+            ancestors[i, k] = 1
+            k = parent[k]
+    return ancestors
+
+def axis_rotation(theta: np.ndarray, axis: str):
+    '''
+    INPUT:     Angles 'theta' in any shape [...], rotation axis 'x', 'y' or 'z'
+    OUTPUT:    Rotation matrices around the axis in shape [..., 3, 3]
+    '''
+    c = np.cos(theta)
+    s = np.sin(theta)
+    zero = np.zeros_like(c)
+    one = np.ones_like(c)
+    if(axis == 'x'):
+        rows = [one, zero, zero, zero, c, -1 * s, zero, s, c]
+    elif(axis == 'y'):
+        rows = [c, zero, s, zero, one, zero, -1 * s, zero, c]
+    else:
+        rows = [c, -1 * s, zero, s, c, zero, zero, zero, one]
+    return np.stack(rows, axis=-1).reshape(c.shape + (3, 3))
+
+def decompose_rotation(mat: np.ndarray):
+    '''
+    INPUT:     Rotation matrices 'mat' in shape [..., 3, 3]
+    OUTPUT:    Angles (yaw, pitch, roll) in shape [...] and their components (R_z, R_y, R_x) in shape [..., 3, 3]
+    ATTENTION: Note the order 'mat = RzRyRx', yaw is around z axis, pitch around y axis and roll around x axis
+    '''
+    roll = np.arctan2(mat[..., 2, 1], mat[..., 2, 2])
+    pitch = np.arctan2(-1 * mat[..., 2, 0], np.sqrt(mat[..., 2, 1]**2 + mat[..., 2, 2]**2))
+    yaw = np.arctan2(mat[..., 1, 0], mat[..., 0, 0])
+    return (yaw, pitch, roll, axis_rotation(yaw, 'z'), axis_rotation(pitch, 'y'), axis_rotation(roll, 'x'))
+
+def remove_yaw(points: np.ndarray, R_z: np.ndarray):
+    '''
+    INPUT:     Points in shape [N, ..., 3], yaw rotations 'R_z' in shape [N, 3, 3]
+    OUTPUT:    Points rotated by the inverse of R_z, in shape [N, ..., 3]
+    ATTENTION: R_z is orthogonal, its transpose replaces the inverse
+    '''
+    num_frame = points.shape[0]
+    return np.matmul(points.reshape(num_frame, -1, 3), R_z).reshape(points.shape)
+
+def axis_rotation_tensor(theta: torch.Tensor, axis: str):
+    '''
+    Tensor version of axis_rotation, differentiable and scriptable.
+    '''
+    c = torch.cos(theta)
+    s = torch.sin(theta)
+    zero = torch.zeros_like(c)
+    one = torch.ones_like(c)
+    if(axis == 'x'):
+        rows = [one, zero, zero, zero, c, -1 * s, zero, s, c]
+    elif(axis == 'y'):
+        rows = [c, zero, s, zero, one, zero, -1 * s, zero, c]
+    else:
+        rows = [c, -1 * s, zero, s, c, zero, zero, zero, one]
+    return torch.stack(rows, dim=-1).reshape(list(c.shape) + [3, 3])
+
+def decompose_rotation_tensor(mat: torch.Tensor):
+    '''
+    Tensor version of decompose_rotation, differentiable and scriptable.
+    '''
+    roll = torch.atan2(mat[..., 2, 1], mat[..., 2, 2])
+    pitch = torch.atan2(-1 * mat[..., 2, 0], torch.sqrt(mat[..., 2, 1]**2 + mat[..., 2, 2]**2))
+    yaw = torch.atan2(mat[..., 1, 0], mat[..., 0, 0])
+    return (yaw, pitch, roll,
+            axis_rotation_tensor(yaw, 'z'), axis_rotation_tensor(pitch, 'y'), axis_rotation_tensor(roll, 'x'))
+
+def remove_yaw_tensor(points: torch.Tensor, R_z: torch.Tensor):
+    '''
+    Tensor version of remove_yaw, differentiable and scriptable.
+    '''
+    return torch.matmul(points.reshape(points.shape[0], -1, 3), R_z).reshape(points.shape)
+
 class INVERSE_KINEMATICS:
 
     def __init__(self):
@@ -37,6 +141,59 @@ class INVERSE_KINEMATICS:
         R = np.matmul(np.matmul(VT.T, diag), U.T)
         return R
     
+    def rodrigues_batch(self, vec_before: np.ndarray, vec_after: np.ndarray):
+        '''
+        INPUT:     Vectors 'vec_before' and 'vec_after' in shape [N, 3]
+        OUTPUT:    Rotation matrices [N, 3, 3] turning direction of 'vec_before' to 'vec_after'
+        ATTENTION: Closed form R = I + K + K^2 / (1 + cos), K is the skew matrix of the unit cross product.
+                   Parallel pairs give identity, anti-parallel pairs a half turn about an axis perpendicular
+                   to 'vec_before'.
+        '''
+        unit_before = vec_before / np.linalg.norm(vec_before, axis=-1, keepdims=True)
+        unit_after = vec_after / np.linalg.norm(vec_after, axis=-1, keepdims=True)
+        vec_axis = np.cross(unit_before, unit_after)
+        cos_angle = np.sum(unit_before * unit_after, axis=-1)
+
+        K = np.zeros(vec_axis.shape[:-1] + (3, 3))
+        K[..., 0, 1] = -vec_axis[..., 2]
+        K[..., 0, 2] = vec_axis[..., 1]
+        K[..., 1, 0] = vec_axis[..., 2]
+        K[..., 1, 2] = -vec_axis[..., 0]
+        K[..., 2, 0] = -vec_axis[..., 1]
+        K[..., 2, 1] = vec_axis[..., 0]
+
+        denominator = 1 + cos_angle
+        scale = np.divide(1, denominator, out=np.zeros_like(denominator), where=denominator > 1e-8)
+        rotation_mat = np.identity(3) + K + scale[..., None, None] * np.matmul(K, K)
+
+        opposite = denominator <= 1e-8
+        if(np.any(opposite)):
+            '''
+            Half turn R = 2uu^T - I about a unit axis u perpendicular to 'vec_before',
+            u is the cross product with the coordinate axis least aligned with 'vec_before'.
+            '''
+            unit_opposite = unit_before[opposite]
+            helper = np.identity(3)[np.argmin(np.abs(unit_opposite), axis=-1)]
+            axis = np.cross(unit_opposite, helper)
+            axis = axis / np.linalg.norm(axis, axis=-1, keepdims=True)
+            rotation_mat[opposite] = 2 * axis[..., :, None] * axis[..., None, :] - np.identity(3)
+        return rotation_mat
+
+    def svd_root_rotation_batch(self, joint_location: np.ndarray, template_location: np.ndarray):
+        '''
+        INPUT:     Joint locations [N, 15, 3] and template locations [N, 15, 3]
+        OUTPUT:    Root rotations [N, 3, 3]
+        '''
+        points_index = [self.config.LHIP, self.config.RHIP, self.config.NECK]
+        q1 = joint_location[:, points_index] - joint_location[:, [self.config.ROOT]]
+        q2 = template_location[:, points_index] - template_location[:, [self.config.ROOT]]
+        H = np.einsum('nki,nkj->nij', q2, q1)
+        U, sigma, VT = np.linalg.svd(H)
+        V = VT.swapaxes(-1, -2)
+        UT = U.swapaxes(-1, -2)
+        V[:, :, 2] *= np.linalg.det(np.matmul(V, UT))[:, None]
+        return np.matmul(V, UT)
+
     def decomposite_rotation_matrix(self, mat: np.ndarray):
         '''
         INPUT:     Rotation matrix 'mat'
@@ -61,6 +218,15 @@ class INVERSE_KINEMATICS:
     
         return (R_z, R_y, R_x)
 
+    def decomposite_rotation_matrix_batch(self, mat: np.ndarray):
+        '''
+        INPUT:     Rotation matrices 'mat' in shape [N, 3, 3]
+        OUTPUT:    Components of 'mat' along x,y,z axis, each in shape [N, 3, 3]
+        ATTENTION: Note the order 'mat = RzRyRx', decompose_rotation also returns the angles
+        '''
+        yaw, pitch, roll, R_z, R_y, R_x = decompose_rotation(mat)
+        return (R_z, R_y, R_x)
+
     def inverse_tree(self, joint_location: np.ndarray, template_location: np.ndarray, R_global: list, R_local: list):
 
         for i in range(1, len(self.config.PARENT)):
@@ -87,79 +253,240 @@ class INVERSE_KINEMATICS:
         R_global, R_local = self.inverse_tree(joint_location, template_location, R_global, R_local)
         return (R_global, R_local)
 
-class FORWARD_KINEMATICS:
+    def inverse_kinematics_batch(self, joint_location: np.ndarray, template_location: np.ndarray):
+        '''
+        INPUT:     Joint locations [N, 15, 3] of a whole recording, template [15, 3] or [N, 15, 3]
+        OUTPUT:    Global and local rotations, both in shape [N, 15, 3, 3]
+        ATTENTION: Frames are processed together, bones are processed level by level of the kinematic tree.
+        '''
+        joint_location = np.asarray(joint_location, dtype=np.float64)
+        template_location = np.broadcast_to(np.asarray(template_location, dtype=np.float64), joint_location.shape)
+        num_frame = joint_location.shape[0]
 
-    def __init__(self):
-        self.config = OPENPOSE_15_CONFIG()
+        R_global = np.empty((num_frame, self.config.NUM_JOINT, 3, 3))
+        R_local = np.empty((num_frame, self.config.NUM_JOINT, 3, 3))
+
+        R_global[:, 0] = self.svd_root_rotation_batch(joint_location, template_location)
+        R_local[:, 0] = R_global[:, 0]
+
+        for (joints, parents) in kinematic_levels(self.config.PARENT):
+            p = joint_location[:, joints] - joint_location[:, parents]
+            t = template_location[:, joints] - template_location[:, parents]
+            '''
+            R_global is orthogonal, its transpose replaces the inverse
+            '''
+            p = np.einsum('nlji,nlj->nli', R_global[:, parents], p)
+            R_local[:, joints] = self.rodrigues_batch(t, p)
+            R_global[:, joints] = np.matmul(R_global[:, parents], R_local[:, joints])
+        return (R_global, R_local)
+
+class R6D_FORWARD_KINEMATICS(torch.autograd.Function):
+    '''
+    r6d decoding and forward kinematics of FORWARD_KINEMATICS_LAYER.r6d_forward_kinematics with a recomputed backward.
+    Only the inputs are kept for backward instead of the rotations of every joint and level,
+    backward runs the forward pass again with autograd and frees its graph right away.
+    Like torch.amp.custom_fwd / custom_bwd, backward replays the autocast state of forward,
+    taken for the device of r6d so that CPU and CUDA autocast are both covered.
+    '''
+    @staticmethod
+    def forward(ctx, layer: nn.Module, r6d: torch.Tensor, template_location: torch.Tensor,
+                R_root: Optional[torch.Tensor]):
+
+        ctx.layer = layer
+        ctx.device_type = r6d.device.type
+        ctx.autocast_enabled = torch.is_autocast_enabled(ctx.device_type)
+        ctx.autocast_dtype = torch.get_autocast_dtype(ctx.device_type)
+        ctx.save_for_backward(r6d, template_location, R_root)
+        return layer.r6d_forward_kinematics(r6d, template_location, R_root)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_location: torch.Tensor):
+
+        inputs = [None if x is None else x.detach().requires_grad_(need)
+                  for (x, need) in zip(ctx.saved_tensors, ctx.needs_input_grad[1:])]
+        with torch.enable_grad(), torch.autocast(ctx.device_type, dtype=ctx.autocast_dtype,
+                                                 enabled=ctx.autocast_enabled):
+            location = ctx.layer.r6d_forward_kinematics(*inputs)
+        differentiable = [x for x in inputs if x is not None and x.requires_grad]
+        grads = iter(torch.autograd.grad(location, differentiable, grad_location, allow_unused=True))
+        return (None, ) + tuple(next(grads) if x is not None and x.requires_grad else None for x in inputs)
+
+class FORWARD_KINEMATICS_LAYER(nn.Module):
+    '''
+    Batched r6d decoding and forward kinematics, usable with torch.compile and TorchScript.
+    The tree is walked level by level, all joints of a level share one matmul.
+    Joint locations are gathered from rotated bones with the ancestor matrix.
+    With recompute_backward, forward keeps only its inputs for backward (see R6D_FORWARD_KINEMATICS),
+    activation memory then does not grow with the number of joints. Scripted modules always keep the activations.
+    The recomputed backward is once_differentiable, double backward (e.g. gradient penalties) raises an error,
+    use recompute_backward=False for it.
+    '''
+    level_size: List[int]
+
+    def __init__(self, recompute_backward: bool = True, eps: float = 1e-12):
+        super(FORWARD_KINEMATICS_LAYER, self).__init__()
+        config = OPENPOSE_15_CONFIG()
+        levels = kinematic_levels(config.PARENT)
+
+        self.recompute_backward = recompute_backward
+        self.eps = eps
+        self.num_joint = config.NUM_JOINT
+        self.level_size = [len(joints) for (joints, parents) in levels]
+        self.register_buffer('level_joint', torch.tensor([i for (joints, parents) in levels for i in joints]),
+                             persistent=False)
+        self.register_buffer('level_parent', torch.tensor([i for (joints, parents) in levels for i in parents]),
+                             persistent=False)
+        self.register_buffer('bone_parent', torch.tensor([0] + config.PARENT[1:]), persistent=False)
+        self.register_buffer('ancestors', torch.tensor(kinematic_ancestors(config.PARENT), dtype=torch.float32),
+                             persistent=False)
+
+    def normalize_tensor(self, x: torch.Tensor, dim: int = -1):
+        '''
+        Zero vectors stay zero, the norm is clamped to eps instead of masking NaNs, which keeps gradients finite.
+        '''
+        return x / x.norm(p=2, dim=dim, keepdim=True).clamp_min(self.eps)
 
-    def normalize_tensor(self, x: torch.Tensor, dim=-1):
-        
-        norm = x.norm(dim=dim, keepdim=True)
-        normalized_x = x / norm
-        normalized_x[torch.isnan(normalized_x)] = 0
-        return normalized_x
-    
     def r6d_to_rotation_matrix(self, r6d: torch.Tensor):
-        
-        r6d = r6d.view((-1, 6))
+
+        r6d = r6d.reshape((-1, 6))
 
         column0 = self.normalize_tensor(r6d[:, 0:3])
         column1 = self.normalize_tensor(r6d[:, 3:6] - (column0 * r6d[:, 3:6]).sum(dim=1, keepdim=True) * column0)
-        column2 = column0.cross(column1, dim=1)
-        
+        column2 = torch.cross(column0, column1, dim=1)
+
         r = torch.stack((column0, column1, column2), dim=-1)
-        r[torch.isnan(r)] = 0
-        
-        return r.view((-1, self.config.NUM_JOINT, 3, 3))
 
-    def forward_tree_batch(self, R_local: torch.Tensor, R_root):
-        
+        return r.view((-1, self.num_joint, 3, 3))
+
+    def forward_tree(self, R_local: torch.Tensor, R_root: Optional[torch.Tensor]):
+        '''
+        INPUT:     Local rotations [B, 15, 3, 3], optional root rotation [B, 1, 3, 3]
+        OUTPUT:    Global rotations [B, 15, 3, 3]
+        '''
         R_local = R_local.view(R_local.shape[0], -1, 3, 3)
+        level_joint = self.level_joint.to(R_local.device)
+        level_parent = self.level_parent.to(R_local.device)
 
+        '''
+        Products are cast to the dtype of R_global, under torch.autocast matmul returns a lower precision dtype.
+        '''
+        R_global = torch.empty_like(R_local)
         if R_root is None:
-            R_global = [R_local[:, 0]]
+            R_global[:, 0] = R_local[:, 0]
         else:
-            R_global = [torch.bmm(R_local[:, 0], R_root[:, 0])]
-        
-        for i in range(1, len(self.config.PARENT)):
-            R_global.append(torch.bmm(R_global[self.config.PARENT[i]], R_local[:, i]))
+            R_global[:, 0] = torch.bmm(R_local[:, 0], R_root[:, 0]).to(R_global.dtype)
 
-        R_global = torch.stack(R_global, dim=1)
+        offset = 0
+        for size in self.level_size:
+            joints = level_joint.narrow(0, offset, size)
+            parents = level_parent.narrow(0, offset, size)
+            R_global.index_copy_(1, joints, torch.matmul(R_global.index_select(1, parents),
+                                                         R_local.index_select(1, joints)).to(R_global.dtype))
+            offset = offset + size
         return R_global
+
+    def forward_kinematics(self, R_global: torch.Tensor, template_location: torch.Tensor):
+        '''
+        INPUT:     Global rotations [B, 15, 3, 3], template [B, 15, 3]
+        OUTPUT:    Joint locations [B, 15, 3, 1]
+        '''
+        template_location = template_location.view(-1, self.num_joint, 3, 1)
+        bone_parent = self.bone_parent.to(template_location.device)
+        ancestors = self.ancestors.to(device=template_location.device, dtype=template_location.dtype)
+        '''
+        The root bone is the root location itself, other bones point from the parent joint.
+        '''
+        bone = template_location - template_location.index_select(1, bone_parent)
+        bone = torch.cat((template_location[:, :1], bone[:, 1:]), dim=1)
+        bone = torch.matmul(R_global, bone)
+
+        return torch.einsum('ik,bkxy->bixy', ancestors, bone)
+
+    def r6d_forward_kinematics(self, r6d: torch.Tensor, template_location: torch.Tensor,
+                               R_root: Optional[torch.Tensor] = None):
+        '''
+        INPUT:     r6d [B, 15 * 6], template [B, 15 * 3], optional root rotation [B, 1, 3, 3] or [K * B, 1, 3, 3]
+        OUTPUT:    Joint locations [B, 15, 3] or [K * B, 15, 3]
+        ATTENTION: K root rotations per sample are stacked along the batch, r6d is decoded once for all of them
+        '''
+        R_local = self.r6d_to_rotation_matrix(r6d)
+        template_location = template_location.reshape(-1, self.num_joint, 3)
+        if R_root is not None and R_root.shape[0] != R_local.shape[0]:
+            assert R_root.shape[0] % R_local.shape[0] == 0, 'R_root batch must be a multiple of the r6d batch'
+            repeat = R_root.shape[0] // R_local.shape[0]
+            R_local = R_local.repeat(repeat, 1, 1, 1)
+            template_location = template_location.repeat(repeat, 1, 1)
+        R_global = self.forward_tree(R_local, R_root)
+        return self.forward_kinematics(R_global, template_location).view(-1, self.num_joint, 3)
+
+    @torch.jit.unused
+    def recomputed_forward(self, r6d: torch.Tensor, template_location: torch.Tensor,
+                           R_root: Optional[torch.Tensor]) -> torch.Tensor:
+
+        return R6D_FORWARD_KINEMATICS.apply(self, r6d, template_location, R_root)
+
+    def forward(self, r6d: torch.Tensor, template_location: torch.Tensor, R_root: Optional[torch.Tensor] = None):
+        '''
+        Same as r6d_forward_kinematics, backward recomputes the activations when recompute_backward is set.
+        '''
+        if torch.jit.is_scripting() or not self.recompute_backward or not torch.is_grad_enabled():
+            return self.r6d_forward_kinematics(r6d, template_location, R_root)
+        return self.recomputed_forward(r6d, template_location, R_root)
+
+class FORWARD_KINEMATICS:
+
+    def __init__(self):
+        self.config = OPENPOSE_15_CONFIG()
+        '''
+        Batched torch methods are served by FORWARD_KINEMATICS_LAYER,
+        numpy methods walk the same kinematic levels.
+        '''
+        self.layer = FORWARD_KINEMATICS_LAYER()
+        self.levels = kinematic_levels(self.config.PARENT)
+        self.ancestors = kinematic_ancestors(self.config.PARENT)
+        self.bone_parent = [0] + self.config.PARENT[1:]
+
+    def normalize_tensor(self, x: torch.Tensor, dim=-1):
+
+        return self.layer.normalize_tensor(x, dim)
+    
+    def r6d_to_rotation_matrix(self, r6d: torch.Tensor):
+
+        return self.layer.r6d_to_rotation_matrix(r6d)
+
+    def forward_tree_batch(self, R_local: torch.Tensor, R_root):
+
+        return self.layer.forward_tree(R_local, R_root)
     
     def forward_tree(self, R_local: np.ndarray, R_root):
 
         R_local = R_local.reshape(-1, 3, 3)
 
+        R_global = np.empty(R_local.shape, dtype=np.result_type(R_local, np.float64))
         if R_root is None:
-            R_global = [R_local[0]]
+            R_global[0] = R_local[0]
         else:
-            R_global = [np.dot(R_local[0], R_root)]
+            R_global[0] = np.dot(R_local[0], R_root)
 
-        for i in range(1, len(self.config.PARENT)):
-            R_global.append(np.dot(R_global[self.config.PARENT[i]], R_local[i]))
-
-        return np.array(R_global)
+        for (joints, parents) in self.levels:
+            R_global[joints] = np.matmul(R_global[parents], R_local[joints])
+        return R_global
     
     def forward_kinematics_batch(self, R_global: torch.Tensor, template_location: torch.Tensor):
-        
-        template_location = template_location.view(-1, self.config.NUM_JOINT, 3, 1)
-        joint_location = [torch.bmm(R_global[:, 0], template_location[:, 0])]
 
-        for i in range(1, len(self.config.PARENT)):
-            joint_location.append(torch.bmm(R_global[:, i], 
-                                            (template_location[:, i] - template_location[:, self.config.PARENT[i]]))
-                                    + joint_location[self.config.PARENT[i]])
-        joint_location = torch.stack(joint_location, dim=1)
-        return joint_location
+        return self.layer.forward_kinematics(R_global, template_location)
+
+    def r6d_forward_kinematics_batch(self, r6d: torch.Tensor, template_location: torch.Tensor, R_root):
+
+        return self.layer(r6d, template_location, R_root)
     
     def forward_kinematics(self, R_global: np.ndarray, template_location: np.ndarray):
 
         template_location = template_location.reshape(-1, 3, 1)
-        joint_location = [np.dot(R_global[0], template_location[0])]
 
-        for i in range(1, len(self.config.PARENT)):
-            joint_location.append(np.dot(R_global[i],
-                                  (template_location[i] - template_location[self.config.PARENT[i]]))
-                                  + joint_location[self.config.PARENT[i]])
-        return np.array(joint_location)
+        bone = template_location - template_location[self.bone_parent]
+        bone[0] = template_location[0]
+        bone = np.matmul(R_global, bone)
+
+        return np.einsum('ik,kxy->ixy', self.ancestors, bone)
@@ -1,13 +1,26 @@
 import torch
 from torch import nn
-from kinematics import FORWARD_KINEMATICS
-from config import OPENPOSE_15_CONFIG
+from typing import Optional, Tuple
+from kinematics import FORWARD_KINEMATICS, FORWARD_KINEMATICS_LAYER
+from config import OPENPOSE_15_CONFIG, LABEL_SCHEMA
+
+'''
+Losses take labels y in the LABEL_SCHEMA layout together with a template table [max id + 1, 15, 3]
+(e.g. SMART_GARMENT_DATASET.template_table), the template of each sample is gathered by its subject id.
+The table is a buffer, so it moves to the device of the loss with .to(device).
+Without a template table the legacy layout is expected, a template copy in columns 45:90 and a root rotation in 90:99,
+LABEL_SCHEMA labels then raise ValueError.
+'''
+
+SCHEMA_LABEL_ERROR = 'labels follow LABEL_SCHEMA, pass template_table (e.g. dataset.template_table) to the loss.'
 
 class L2_LOSS(nn.Module):
     
-    def __init__(self):
+    def __init__(self, template_table: Optional[torch.Tensor] = None):
         super(L2_LOSS, self).__init__()
+        self.schema = LABEL_SCHEMA()
         self.forward_k_unit = FORWARD_KINEMATICS()
+        self.register_buffer('template_table', template_table, persistent=False)
 
     def forward(self, pred: torch.Tensor, y: torch.Tensor):
         '''
@@ -16,29 +29,31 @@ class L2_LOSS(nn.Module):
         3. calculate L2 loss
         '''
         r6d = pred.view(-1, 15, 6)
-        y_location = y[:, 0:45].view(-1, 15, 3)
-        y_template = y[:, 45:90].view(-1, 15, 3)
+        y_location = y[:, self.schema.JOINT_START: self.schema.JOINT_END].reshape(-1, 15, 3)
+        if self.template_table is None:
+            if y.shape[1] == self.schema.SIZE:
+                raise ValueError(SCHEMA_LABEL_ERROR)
+            y_template = y[:, self.schema.LEGACY_TEMPLATE_START: self.schema.LEGACY_TEMPLATE_END].reshape(-1, 15, 3)
+        else:
+            y_template = self.template_table.index_select(0, y[:, self.schema.SUBJECT].long())
 
-        pred_R_local = self.forward_k_unit.r6d_to_rotation_matrix(r6d)
-        pred_R_global = self.forward_k_unit.forward_tree_batch(pred_R_local, None)
-        pred_location = self.forward_k_unit.forward_kinematics_batch(pred_R_global, y_template).view(-1, 15, 3)
+        pred_location = self.forward_k_unit.r6d_forward_kinematics_batch(r6d, y_template, None)
         
         L2_loss = torch.mean(torch.norm(pred_location - y_location, dim=2, p=2), dim=0)
         return L2_loss
     
 class LC_LOSS(nn.Module):
 
-    def __init__(self):
+    def __init__(self, template_table: Optional[torch.Tensor] = None):
         super(LC_LOSS, self).__init__()
         self.config = OPENPOSE_15_CONFIG()
+        self.schema = LABEL_SCHEMA()
         self.forward_k_unit = FORWARD_KINEMATICS()
+        self.register_buffer('parent_index', torch.tensor([0] + self.config.PARENT[1:]), persistent=False)
+        self.register_buffer('template_table', template_table, persistent=False)
 
     def transfer_relative_location(self, x: torch.Tensor):
-        parent_location = [x[:, 0, :]]
-        for i in range(1, 15):
-            parent_location.append(x[:, self.config.PARENT[i], :])
-        parent_location = torch.stack(parent_location, dim=1)
-        return x - parent_location
+        return x - x.index_select(1, self.parent_index.to(x.device))
 
     def forward(self, pred: torch.Tensor, y: torch.Tensor):
         '''
@@ -47,16 +62,90 @@ class LC_LOSS(nn.Module):
         3. calculate LC loss
         '''
         r6d = pred.view(-1, 15, 6)
-        y_location = y[:, 0:45].view(-1, 15, 3)
-        y_template = y[:, 45:90].view(-1, 15, 3)
-        y_rotation = y[:, 90:99].view(-1, 1, 3, 3)
+        y_location = y[:, self.schema.JOINT_START: self.schema.JOINT_END].reshape(-1, 15, 3)
+        if self.template_table is None:
+            if y.shape[1] == self.schema.SIZE:
+                raise ValueError(SCHEMA_LABEL_ERROR)
+            y_template = y[:, self.schema.LEGACY_TEMPLATE_START: self.schema.LEGACY_TEMPLATE_END].reshape(-1, 15, 3)
+            y_rotation = y[:, self.schema.LEGACY_ROOT_ROTATION_START: self.schema.LEGACY_ROOT_ROTATION_END]
+        else:
+            y_template = self.template_table.index_select(0, y[:, self.schema.SUBJECT].long())
+            y_rotation = y[:, self.schema.ROOT_ROTATION_START: self.schema.ROOT_ROTATION_END]
+        y_rotation = y_rotation.reshape(-1, 1, 3, 3)
 
-        pred_R_local = self.forward_k_unit.r6d_to_rotation_matrix(r6d)
-        pred_R_global = self.forward_k_unit.forward_tree_batch(pred_R_local, y_rotation)
-        pred_location = self.forward_k_unit.forward_kinematics_batch(pred_R_global, y_template).view(-1, 15, 3)
+        pred_location = self.forward_k_unit.r6d_forward_kinematics_batch(r6d, y_template, y_rotation)
 
         relative_y = self.transfer_relative_location(y_location)
         relative_pred = self.transfer_relative_location(pred_location)
 
         lc_loss = 50.0 * torch.mean(1.0 - torch.nn.functional.cosine_similarity(relative_y, relative_pred, dim=2), dim=0)
         return lc_loss
+
+class JOINT_LOSS(nn.Module):
+    '''
+    L2 and LC loss in one module, r6d decoding and forward kinematics run once for both terms.
+    Scriptable with TorchScript and traceable by torch.compile.
+    '''
+    def __init__(self, l2_weight: float = 1.0, lc_weight: float = 50.0, template_table: Optional[torch.Tensor] = None):
+        super(JOINT_LOSS, self).__init__()
+        schema = LABEL_SCHEMA()
+        self.l2_weight = l2_weight
+        self.lc_weight = lc_weight
+        '''
+        Label offsets are kept as int attributes, TorchScript does not compile the schema object.
+        '''
+        self.joint_end = schema.JOINT_END
+        self.subject = schema.SUBJECT
+        self.root_rotation_start = schema.ROOT_ROTATION_START
+        self.root_rotation_end = schema.ROOT_ROTATION_END
+        self.legacy_template_start = schema.LEGACY_TEMPLATE_START
+        self.legacy_template_end = schema.LEGACY_TEMPLATE_END
+        self.legacy_root_rotation_start = schema.LEGACY_ROOT_ROTATION_START
+        self.legacy_root_rotation_end = schema.LEGACY_ROOT_ROTATION_END
+        self.label_size = schema.SIZE
+        self.forward_k_layer = FORWARD_KINEMATICS_LAYER()
+        self.register_buffer('parent_index', self.forward_k_layer.bone_parent.clone(), persistent=False)
+        self.register_buffer('template_table', template_table, persistent=False)
+
+    def forward(self, pred: torch.Tensor, y: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+        1. convert r6d output (15, 6) to rotation matrix (15, 3, 3) once
+        2. reconstruct joint location (15, 3) in a single FK pass,
+           when y carries a root rotation (schema labels, or 99 legacy columns) the L2 branch without root
+           and the LC branch with root are stacked along the batch dimension,
+           the activations of the pass are recomputed in backward (see FORWARD_KINEMATICS_LAYER)
+        3. return weighted L2 loss and LC loss, both in shape (15, )
+        '''
+        r6d = pred.view(-1, 15, 6)
+        y_location = y[:, 0: self.joint_end].reshape(-1, 15, 3)
+        batch = r6d.shape[0]
+
+        y_rotation: Optional[torch.Tensor] = None
+        template_table = self.template_table
+        if template_table is None:
+            if y.shape[1] == self.label_size:
+                raise ValueError('labels follow LABEL_SCHEMA, pass template_table (e.g. dataset.template_table) to the loss.')
+            y_template = y[:, self.legacy_template_start: self.legacy_template_end].reshape(-1, 15, 3)
+            if y.shape[1] >= self.legacy_root_rotation_end:
+                y_rotation = y[:, self.legacy_root_rotation_start: self.legacy_root_rotation_end].reshape(-1, 1, 3, 3)
+        else:
+            y_template = template_table.index_select(0, y[:, self.subject].long())
+            y_rotation = y[:, self.root_rotation_start: self.root_rotation_end].reshape(-1, 1, 3, 3)
+
+        if y_rotation is not None:
+            identity = torch.eye(3, dtype=y.dtype, device=y.device).expand(batch, 1, 3, 3)
+            pred_location = self.forward_k_layer(r6d, y_template, torch.cat((identity, y_rotation), dim=0))
+            l2_location = pred_location[:batch]
+            lc_location = pred_location[batch:]
+        else:
+            l2_location = self.forward_k_layer(r6d, y_template)
+            lc_location = l2_location
+
+        l2_loss = torch.mean(torch.linalg.vector_norm(l2_location - y_location, dim=2), dim=0)
+
+        parent_index = self.parent_index.to(y.device)
+        relative_y = y_location - y_location.index_select(1, parent_index)
+        relative_pred = lc_location - lc_location.index_select(1, parent_index)
+        lc_loss = torch.mean(1.0 - torch.nn.functional.cosine_similarity(relative_y, relative_pred, dim=2), dim=0)
+
+        return (self.l2_weight * l2_loss, self.lc_weight * lc_loss)
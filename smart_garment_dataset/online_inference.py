@@ -0,0 +1,109 @@
+import time
+import torch
+import numpy as np
+from torch import nn
+from h5_dataset import process_pressure_images, PRESSURE_MAX
+from kinematics import FORWARD_KINEMATICS_LAYER
+from config import OPENPOSE_15_CONFIG
+
+class RING_BUFFER:
+    '''
+    Last window_len preprocessed frames of one wearer.
+    Every frame is written twice, at position k and k + window_len of a buffer of 2 * window_len frames,
+    so the latest window is always the contiguous view buffer[k + 1: k + 1 + window_len] and is never copied.
+    '''
+    def __init__(self, window_len: int, frame_shape: tuple = (2, 64, 32)):
+
+        self.window_len = window_len
+        self.buffer = np.zeros((2 * window_len, ) + tuple(frame_shape), dtype=np.float32)
+        self.position = -1
+        self.num_frame = 0
+
+    def push(self, frame: np.ndarray):
+        '''
+        Preprocess a raw frame [2, 64, 32] the same way as H5_DATASET.pressure_image_process
+        and normalize it to [0, 1], the result is written straight into the buffer.
+        '''
+        self.position = (self.position + 1) % self.window_len
+        image = self.buffer[self.position: self.position + 1]
+        process_pressure_images(np.asarray(frame)[None], out=image)
+        image /= PRESSURE_MAX
+        self.buffer[self.position + self.window_len] = image[0]
+        self.num_frame = self.num_frame + 1
+
+    def ready(self):
+        return self.num_frame >= self.window_len
+
+    def window(self):
+        '''
+        Latest window [window_len, 2, 64, 32] as a view on the buffer, oldest frame first.
+        '''
+        return self.buffer[self.position + 1: self.position + 1 + self.window_len]
+
+class ONLINE_INFERENCE:
+    '''
+    Online pose inference from raw garment frames, one frame per wearer at a time.
+    Frames are preprocessed as they arrive and kept in a ring buffer per wearer,
+    windows of all wearers with a full buffer are stacked and passed to the model as one batch,
+    r6d outputs [B, 90] are decoded to joint locations [15, 3] with the template of each wearer.
+    '''
+    def __init__(self, model: nn.Module, window_len: int, device: str = 'cpu', max_batch: int = 64):
+        '''
+        model maps pressure windows [B, window_len, 2, 64, 32] to r6d rotations [B, 90]
+        max_batch limits the number of windows passed to the model at once
+        '''
+        self.config = OPENPOSE_15_CONFIG()
+        self.model = model.to(device).eval()
+        self.window_len = window_len
+        self.device = torch.device(device)
+        self.max_batch = max_batch
+        self.forward_k_layer = FORWARD_KINEMATICS_LAYER().to(self.device)
+        self.buffers = {}
+        self.templates = {}
+        self.latency = 0.0
+
+    def add_wearer(self, wearer_id, template: np.ndarray):
+        '''
+        template: [15, 3] joint locations of the wearer in the label axis order, e.g. H5_DATASET.template
+        '''
+        self.buffers[wearer_id] = RING_BUFFER(self.window_len)
+        self.templates[wearer_id] = torch.as_tensor(np.asarray(template, dtype=np.float32),
+                                                    device=self.device).reshape(self.config.NUM_JOINT, 3)
+
+    def remove_wearer(self, wearer_id):
+        del self.buffers[wearer_id]
+        del self.templates[wearer_id]
+
+    def push(self, wearer_id, frame: np.ndarray):
+        self.buffers[wearer_id].push(frame)
+
+    def step(self, frames: dict):
+        '''
+        frames: {wearer id: raw frame [2, 64, 32]} received in this sensor period
+        return: {wearer id: joint locations [15, 3]} of every wearer whose buffer holds a full window
+        '''
+        time_start = time.perf_counter()
+        for (wearer_id, frame) in frames.items():
+            self.push(wearer_id, frame)
+        wearers = [wearer_id for wearer_id in frames if self.buffers[wearer_id].ready()]
+        joints = {}
+        for start in range(0, len(wearers), self.max_batch):
+            batch = wearers[start: start + self.max_batch]
+            joint = self.infer(batch)
+            for (wearer_id, location) in zip(batch, joint):
+                joints[wearer_id] = location
+        self.latency = time.perf_counter() - time_start
+        return joints
+
+    @torch.inference_mode()
+    def infer(self, wearers: list):
+        '''
+        Run the model on the latest windows of wearers as one batch and decode the joint locations.
+        '''
+        window = np.stack([self.buffers[wearer_id].window() for wearer_id in wearers])
+        pressure = torch.from_numpy(window).to(self.device, non_blocking=True)
+        template = torch.stack([self.templates[wearer_id] for wearer_id in wearers])
+
+        r6d = self.model(pressure).reshape(len(wearers), self.config.NUM_JOINT, 6)
+        joint = self.forward_k_layer(r6d.float(), template)
+        return joint.cpu().numpy()
@@ -0,0 +1,168 @@
+import os
+import sys
+import copy
+import json
+import time
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+'''
+Stage-level instrumentation of dataset construction.
+A stage is a timed block of code, a counter accumulates values such as bytes read and frames processed.
+Stages and counters are grouped by the session open when they are recorded.
+'''
+
+NULL_STAGE = contextlib.nullcontext()
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of the current process in MB, None where it is not available.
+    The peak is taken over the whole lifetime of the process, it never goes down.
+    '''
+    if(resource is None):
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    '''
+    ru_maxrss is given in bytes on macOS and in kilobytes on Linux.
+    '''
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+class STAGE_PROFILER:
+    '''
+    Timers and counters around the stages of dataset construction.
+    A disabled profiler records nothing, stage() then returns a shared empty context and count() returns at once.
+    '''
+    def __init__(self, enabled: bool = True):
+
+        self.enabled = enabled
+        self.events = []
+        self.counters = {}
+        self.sessions = {}
+        self.session_name = None
+        '''
+        Events start at wall-clock seconds, perf_counter() + clock_offset, so events of several processes
+        share one time axis.
+        '''
+        self.clock_offset = time.time() - time.perf_counter()
+
+    def stage(self, name: str, **args):
+        '''
+        with profiler.stage('pressure_image_process', frames=n): ...
+        '''
+        if(not self.enabled):
+            return NULL_STAGE
+        return self.record_stage(name, args)
+
+    @contextlib.contextmanager
+    def record_stage(self, name: str, args: dict):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stop = time.perf_counter()
+            self.events.append({'name': name, 'session': self.session_name, 'start': start + self.clock_offset,
+                                'duration': stop - start, 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                'args': args})
+
+    def count(self, name: str, value: float = 1):
+        '''
+        Add value to the counter name of the current session.
+        '''
+        if(not self.enabled):
+            return
+        counters = self.counters.setdefault(self.session_name, {})
+        counters[name] = counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def session(self, name: str):
+        '''
+        Group the stages and counters recorded inside the block under session name, e.g. 'participant1_section2'.
+        Memory of a session is the growth of its process' peak RSS during the session (0 when the session stays
+        below an earlier peak) and the process peak at its end, see peak_rss_mb.
+        '''
+        if(not self.enabled):
+            yield
+            return
+        outer_name = self.session_name
+        self.session_name = name
+        peak_before = peak_rss_mb()
+        try:
+            with self.record_stage('session', {}):
+                yield
+        finally:
+            peak_after = peak_rss_mb()
+            self.sessions[name] = {'pid': os.getpid(), 'process_peak_rss_mb': peak_after,
+                                   'peak_rss_growth_mb': None if peak_after is None else peak_after - peak_before}
+            self.session_name = outer_name
+
+    def merge(self, report: dict):
+        '''
+        Add the records of another profiler, e.g. one running in a worker process, given as its raw() output.
+        Event times are wall-clock times, so worker events line up with the events of this process.
+        '''
+        if(not self.enabled):
+            return
+        self.events.extend(report['events'])
+        for (session_name, counters) in report['counters'].items():
+            merged = self.counters.setdefault(session_name, {})
+            for (name, value) in counters.items():
+                merged[name] = merged.get(name, 0) + value
+        self.sessions.update(report['sessions'])
+
+    def raw(self):
+        '''
+        Picklable records of the profiler, the input of merge.
+        '''
+        return {'events': self.events, 'counters': self.counters, 'sessions': self.sessions}
+
+    def report(self):
+        '''
+        Per-session report: total seconds and calls of each stage, counters and memory (see session).
+        Records outside any session are reported under the session None.
+        Peak RSS is reported per process, as it covers the whole lifetime of a process and not a single session.
+        '''
+        sessions = {}
+        empty = {'stages': {}, 'counters': {}, 'pid': None, 'process_peak_rss_mb': None, 'peak_rss_growth_mb': None}
+        for event in self.events:
+            session = sessions.setdefault(event['session'], copy.deepcopy(empty))
+            stage = session['stages'].setdefault(event['name'], {'seconds': 0.0, 'calls': 0})
+            stage['seconds'] = stage['seconds'] + event['duration']
+            stage['calls'] = stage['calls'] + 1
+        for (session_name, counters) in self.counters.items():
+            sessions.setdefault(session_name, copy.deepcopy(empty))['counters'] = counters
+        for (session_name, info) in self.sessions.items():
+            sessions.setdefault(session_name, copy.deepcopy(empty)).update(info)
+        process_peak = {}
+        for info in self.sessions.values():
+            if(info['process_peak_rss_mb'] is not None):
+                process_peak[info['pid']] = max(process_peak.get(info['pid'], 0.0), info['process_peak_rss_mb'])
+        process_peak[os.getpid()] = peak_rss_mb()
+        return {'sessions': [dict(session=session_name, **session) for (session_name, session) in sessions.items()],
+                'process_peak_rss_mb': {str(pid): peak for (pid, peak) in process_peak.items()}}
+
+    def save_json(self, path: str):
+
+        with open(path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=4)
+
+    def save_chrome_trace(self, path: str):
+        '''
+        Write the stages in Chrome trace event format, open the file in chrome://tracing or Perfetto.
+        '''
+        origin = min((event['start'] for event in self.events), default=0.0)
+        trace = [{'name': event['name'], 'cat': str(event['session']), 'ph': 'X',
+                  'ts': (event['start'] - origin) * 1e6, 'dur': event['duration'] * 1e6,
+                  'pid': event['pid'], 'tid': event['tid'], 'args': event['args']} for event in self.events]
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, trace_file)
+
+'''
+Shared disabled profiler, the default of every class accepting a profiler.
+'''
+DISABLED_PROFILER = STAGE_PROFILER(enabled=False)
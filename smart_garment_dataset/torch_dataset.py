@@ -1,44 +1,592 @@
+import os
+import time
+import contextlib
+import tempfile
 import torch
-from torch.utils.data import Dataset
-from h5_dataset import H5_DATASET
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from torch import distributed
+from torch.utils.data import Dataset, DataLoader, Sampler, BatchSampler, RandomSampler, SequentialSampler
+from h5_dataset import H5_DATASET, make_window_label, make_template_table, select_segments, segment_windows, \
+    clip_segments, window_span, window_runs, session_posture_segments, encode_pressure, pressure_normalize, \
+    pressure_to_tensor, decode_pressure
+from dataset_store import DATASET_STORE
+from config import LABEL_SCHEMA
+from profiling import STAGE_PROFILER, DISABLED_PROFILER
+
+def build_session(name:int, section:int, window_len:int, pose_id, build_dir:str, profile:bool = False,
+                  pressure_dtype:str = 'float32', dilation:int = 1, window_range:tuple = None):
+    '''
+    Build the pressure buffer and window labels of one session, or of its windows in window_range,
+    used by worker processes. Arrays are written as .npy files to build_dir instead of being pickled back to the parent.
+    Returns (pressure path, label path, window start, number of frames, number of windows, build seconds,
+    records of the worker's profiler).
+    '''
+    time_start = time.perf_counter()
+    profiler = STAGE_PROFILER(enabled=profile)
+
+    with profiler.session(session_name(name, section, window_range)):
+        h5_dataset = H5_DATASET(name, section, lazy=window_range is not None, profiler=profiler)
+        h5_dataset.pressure_image_process()
+        pressure, label, window_start = h5_dataset.make_buffer(window_len, pose_id, pressure_dtype, dilation,
+                                                               window_range)
+
+    pressure_path = os.path.join(build_dir, f'{session_name(name, section, window_range)}_pressure.npy')
+    label_path = os.path.join(build_dir, f'{session_name(name, section, window_range)}_label.npy')
+    np.save(pressure_path, pressure)
+    np.save(label_path, label)
+
+    return (pressure_path, label_path, window_start, pressure.shape[0], label.shape[0], time.perf_counter() - time_start,
+            profiler.raw())
+
+def session_name(name:int, section:int, window_range:tuple = None):
+    '''
+    Name of a session, or of the windows of a session starting at frames window_range, for logs and profiles.
+    '''
+    if(window_range is None):
+        return f'participant{name}_section{section}'
+    return f'participant{name}_section{section}_frame{window_range[0]}-{window_range[1]}'
+
+def distributed_rank(rank:int = None, num_replicas:int = None):
+    '''
+    (rank, number of ranks), each taken from torch.distributed when it is initialized and it is not given.
+    '''
+    initialized = distributed.is_available() and distributed.is_initialized()
+    if(num_replicas is None):
+        num_replicas = distributed.get_world_size() if initialized else 1
+    if(rank is None):
+        rank = distributed.get_rank() if initialized else 0
+    if(not 0 <= rank < num_replicas):
+        raise ValueError(f'rank {rank} is out of range for {num_replicas} ranks.')
+    return (rank, num_replicas)
+
+def shard_grouping(grouping:list, window_start:list, rank:int, num_replicas:int, max_imbalance:float = 1.1):
+    '''
+    (name, section, window range) of the sessions assigned to rank, balanced by window count over num_replicas ranks.
+    window_start holds the start frames of the windows of every session in grouping.
+    Whole sessions are taken from the largest down, each goes to the rank with the fewest windows so far
+    (ties to the lower rank), their window range is None and the sessions of a rank keep their order in grouping.
+    With more ranks than sessions, or when a rank would hold more than max_imbalance times the mean window count,
+    the windows of all sessions are split into num_replicas contiguous ranges instead. A split session keeps the windows
+    starting at frames [start, stop) of its window range, so no window is lost or held twice.
+    Every rank computes the same assignment.
+    '''
+    num_window = [start.shape[0] for start in window_start]
+    load = [0] * num_replicas
+    owner = [0] * len(grouping)
+    for i in sorted(range(len(grouping)), key=lambda i: (-num_window[i], i)):
+        owner[i] = load.index(min(load))
+        load[owner[i]] = load[owner[i]] + num_window[i]
+    total = sum(num_window)
+    if(num_replicas <= len(grouping) and max(load) <= max_imbalance * total / num_replicas):
+        return [(name, section, None) for ((name, section), k) in zip(grouping, owner) if k == rank]
+
+    first, last = rank * total // num_replicas, (rank + 1) * total // num_replicas
+    shard = []
+    offset = 0
+    for ((name, section), start) in zip(grouping, window_start):
+        begin, end = max(first - offset, 0), min(last - offset, start.shape[0])
+        if(begin < end):
+            whole = begin == 0 and end == start.shape[0]
+            shard.append((name, section, None if whole else (int(start[begin]), int(start[end - 1]) + 1)))
+        offset = offset + start.shape[0]
+    return shard
 
 class SMART_GARMENT_DATASET(Dataset):
     '''
     Torch dataset directly accessed by the neural network.
+    Pressure frames of all sessions are kept once in a contiguous buffer of the storage dtype,
+    windows are returned lazily as views on the buffer.
+    In lazy mode only the window index and labels are kept in memory,
+    pressure windows are read from the .h5 files in __getitem__, or from a compiled store (see dataset_store.py).
     '''
-    def __init__(self, grouping:tuple, window_len:int, pose_id:int):
+    def __init__(self, grouping:tuple, window_len:int, pose_id, lazy:bool = False, num_workers:int = 0,
+                 store = None, profiler = DISABLED_PROFILER, pressure_dtype:str = 'float32',
+                 defer_normalize:bool = False, shard:bool = False, rank:int = None, num_replicas:int = None,
+                 window_stride:int = 1, dilation:int = 1, random_offset:bool = False, seed:int = 0):
         '''
         grouping is a list consists of (name, section) pairs
+        pose_id is a pose identifier, a list of them, or -1 for all poses,
+        windows of selected poses never cross the boundary of a posture segment
+        num_workers > 1 builds sessions in a process pool
+        store is a DATASET_STORE or the directory of a compiled store, which replaces the raw .h5 files
+        profiler is a STAGE_PROFILER recording the construction stages of every session,
+        e.g. profiler.save_json('report.json') after the dataset is built
+        pressure_dtype is the storage dtype of pressure, 'uint16', 'float16' or 'float32' (see PRESSURE_ENCODING),
+        a store keeps the dtype it was compiled with
+        defer_normalize returns windows in the storage dtype, batches are then normalized by decode_pressure,
+        e.g. on the training device, which saves memory and host-to-device transfer; labels are always float32
+        shard loads only the sessions assigned to this rank (see shard_grouping), rank and num_replicas
+        are taken from torch.distributed if they are not given, use SHARD_SAMPLER to draw the windows;
+        sessions are split into window ranges when there are more ranks than sessions or whole sessions balance poorly
+        Labels follow LABEL_SCHEMA, template_table [max id + 1, 15, 3] holds the templates of all participants
+        in grouping (or in the store) and is the same on every rank, pass it to the loss functions.
+        dilation takes the window_len frames of a window every dilation frames, the label is the middle taken frame
+        window_stride keeps every window_stride-th window of a posture segment, ceil(windows / window_stride) of them,
+        so short segments keep one window; random_offset shifts them by an offset drawn per segment and epoch
+        from seed (see make_runs and set_epoch);
+        stride and offset are applied when windows are accessed, the buffer and labels hold all windows
         '''
-        self.data_tensor, self.label_tensor = self.make_tensor(grouping, window_len, pose_id)
-        print(f'Dataset data size: {self.data_tensor.size()}')
+        self.profiler = profiler
+        self.window_len = window_len
+        self.window_stride = window_stride
+        self.dilation = dilation
+        self.random_offset = random_offset
+        self.seed = seed
+        self.store = DATASET_STORE(store) if isinstance(store, str) else store
+        self.lazy = lazy or self.store is not None
+        self.pressure_dtype = self.store.pressure_dtype if self.store is not None else pressure_dtype
+        self.pressure_normalize = pressure_normalize(self.pressure_dtype)
+        self.defer_normalize = defer_normalize
+        if(self.store is not None):
+            self.template_table = torch.from_numpy(self.store.template_table())
+        else:
+            self.template_table = torch.from_numpy(make_template_table([name for (name, section) in grouping]))
+        self.rank, self.num_replicas = distributed_rank(rank, num_replicas) if shard else (0, 1)
+        if(self.num_replicas > 1):
+            grouping = shard_grouping(grouping, self.session_windows(grouping, window_len, pose_id), self.rank,
+                                      self.num_replicas)
+            print(f'Dataset shard {self.rank}/{self.num_replicas}: {grouping}')
+        else:
+            grouping = [(name, section, None) for (name, section) in grouping]
+        self.grouping = grouping
+        if(self.store is not None):
+            self.sessions = None
+            self.label_tensor, self.window_session, self.window_start = \
+                self.make_store_index(grouping, window_len, pose_id)
+            print(f'Dataset sessions: {len(grouping)}')
+        elif(lazy):
+            self.sessions, self.label_tensor, self.window_session, self.window_start = \
+                self.make_index(grouping, window_len, pose_id)
+            print(f'Dataset sessions: {len(self.sessions)}')
+        else:
+            self.pressure_tensor, self.label_tensor, self.window_start = \
+                self.make_tensor(grouping, window_len, pose_id, num_workers)
+            print(f'Dataset pressure buffer size: {self.pressure_tensor.size()}, dtype: {self.pressure_dtype}')
+        self.make_runs()
+        print(f'Dataset data size: {torch.Size((len(self), window_len, 2, 64, 32))}')
         print(f'Dataset label size: {self.label_tensor.size()}')
 
-    def make_tensor(self, grouping:list, window_len:int, pose_id:int):
+    def session_windows(self, grouping:list, window_len:int, pose_id):
+        '''
+        Start frames of the windows of every session in grouping, from the posture labels only, used for sharding.
+        '''
+        window_start = []
+        for (name, section) in grouping:
+            if(self.store is not None):
+                offset, num_frame = self.store.session_frames(name, section)
+                segments = self.store.session_segments(name, section)
+            else:
+                segments, num_frame = session_posture_segments(name, section)
+            segments = select_segments(segments, pose_id, num_frame)
+            window_start.append(segment_windows(segments, window_span(window_len, self.dilation)))
+        return window_start
+
+    def make_tensor(self, grouping:list, window_len:int, pose_id:int, num_workers:int = 0):
+        '''
+        Returns the concatenated pressure buffer, window labels and the buffer frame each window starts at.
+        grouping holds (name, section, window range) triples (see shard_grouping).
+        Windows never cross the boundary of a session or a posture segment.
+        Split sessions are read lazily, so only the frames of their windows are read and processed.
+        '''
+        if(num_workers > 1):
+            return self.make_tensor_parallel(grouping, window_len, pose_id, num_workers)
+
+        pressure_buffer = []
+        label_buffer = []
+        start_buffer = []
+
+        for (name, section, window_range) in grouping:
+
+            print(f'name: {name}, section: {section}.' + (f' frames: {window_range}' if window_range else ''))
+
+            with self.profiler.session(session_name(name, section, window_range)):
+                h5_dataset = H5_DATASET(name, section, lazy=window_range is not None, profiler=self.profiler)
+                h5_dataset.pressure_image_process()
+
+                pressure, label, window_start = h5_dataset.make_buffer(window_len, pose_id, self.pressure_dtype,
+                                                                       self.dilation, window_range)
+
+            pressure_buffer.append(pressure)
+            label_buffer.append(label)
+            start_buffer.append(window_start)
+
+        return self.concatenate_sessions(pressure_buffer, label_buffer, start_buffer)
 
-        data_tensor = []
+    def make_tensor_parallel(self, grouping:list, window_len:int, pose_id:int, num_workers:int):
+        '''
+        Same as make_tensor, sessions are built by num_workers processes.
+        Workers hand back .npy files in a temporary directory, which are memory mapped and
+        concatenated in grouping order so the result does not depend on completion order.
+        '''
+        time_start = time.perf_counter()
+        results = [None] * len(grouping)
+
+        with tempfile.TemporaryDirectory(prefix='smart_garment_') as build_dir:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = {executor.submit(build_session, name, section, window_len, pose_id, build_dir,
+                                           self.profiler.enabled, self.pressure_dtype, self.dilation, window_range): i
+                           for i, (name, section, window_range) in enumerate(grouping)}
+                for num_done, future in enumerate(as_completed(futures), start=1):
+                    i = futures[future]
+                    results[i] = future.result()
+                    self.profiler.merge(results[i][6])
+                    name, section, window_range = grouping[i]
+                    print(f'name: {name}, section: {section}. frames: {results[i][3]}, windows: {results[i][4]}, '
+                          f'time: {results[i][5]:.2f}s ({num_done}/{len(grouping)})')
+
+            pressure_buffer = [np.load(result[0], mmap_mode='r') for result in results]
+            label_buffer = [np.load(result[1]) for result in results]
+            start_buffer = [result[2] for result in results]
+            tensors = self.concatenate_sessions(pressure_buffer, label_buffer, start_buffer)
+
+        print(f'Built {len(grouping)} sessions with {num_workers} workers in {time.perf_counter() - time_start:.2f}s.')
+        return tensors
+
+    def empty_label(self):
+        '''
+        Labels of no window, concatenated with the labels of the sessions so that a shard without sessions is empty.
+        '''
+        return np.zeros((0, LABEL_SCHEMA().SIZE), dtype=np.float32)
+
+    def concatenate_sessions(self, pressure_buffer:list, label_buffer:list, start_buffer:list):
+        '''
+        Concatenate per-session pressure buffers and labels, window starts are offset by the frames before each session.
+        '''
+        window_start = []
+        num_frame = 0
+        for (pressure, start) in zip(pressure_buffer, start_buffer):
+            window_start.append(num_frame + start)
+            num_frame = num_frame + pressure.shape[0]
+
+        with self.profiler.stage('torch_cat', sessions=len(pressure_buffer)):
+            pressure_tensor = pressure_to_tensor(np.concatenate(
+                pressure_buffer + [np.zeros((0, 2, 64, 32), dtype=self.pressure_dtype)], axis=0))
+            label_tensor = torch.from_numpy(np.concatenate(label_buffer + [self.empty_label()], axis=0))
+            window_start = np.concatenate(window_start + [np.zeros(0, dtype=np.int64)])
+
+        return (pressure_tensor, label_tensor, window_start)
+
+    def make_index(self, grouping:list, window_len:int, pose_id:int):
+        '''
+        Returns lazy session readers, window labels and the (session, .h5 start frame) index of every window.
+        '''
+        sessions = []
         label_tensor = []
+        window_session = []
+        window_start = []
 
-        for (name, section) in grouping:
+        for (name, section, window_range) in grouping:
+
+            print(f'name: {name}, section: {section}.' + (f' frames: {window_range}' if window_range else ''))
+
+            with self.profiler.session(session_name(name, section, window_range)):
+                h5_dataset = H5_DATASET(name, section, lazy=True, profiler=self.profiler)
+                h5_dataset.pressure_image_process()
+
+                start, label = h5_dataset.make_window_index(window_len, pose_id, self.dilation, window_range)
+
+                with self.profiler.stage('tensor_conversion'):
+                    label_tensor.append(torch.from_numpy(label))
+            window_session.append(np.full(label.shape[0], len(sessions)))
+            window_start.append(start)
+            sessions.append(h5_dataset)
+            '''
+            Reads in __getitem__ are not part of the construction and are not recorded.
+            '''
+            h5_dataset.profiler = DISABLED_PROFILER
+
+        with self.profiler.stage('torch_cat', sessions=len(sessions)):
+            label_tensor = torch.cat(label_tensor + [torch.from_numpy(self.empty_label())], dim=0)
+            window_session = np.concatenate(window_session + [np.zeros(0, dtype=np.int64)])
+            window_start = np.concatenate(window_start + [np.zeros(0, dtype=np.int64)])
 
-            print(f'name: {name}, section: {section}.')
+        return (sessions, label_tensor, window_session, window_start)
 
-            h5_dataset = H5_DATASET(name, section)
-            h5_dataset.pressure_image_process()
+    def make_store_index(self, grouping:list, window_len:int, pose_id:int):
+        '''
+        Same as make_index for sessions of a compiled store, window starts refer to store frames.
+        '''
+        label_tensor = []
+        window_session = []
+        window_start = []
+
+        span = window_span(window_len, self.dilation)
+        for i, (name, section, window_range) in enumerate(grouping):
+            with self.profiler.session(session_name(name, section, window_range)):
+                offset, num_frame = self.store.session_frames(name, section)
+                with self.profiler.stage('posture_index'):
+                    segments = select_segments(self.store.session_segments(name, section), pose_id, num_frame)
+                    start = segment_windows(clip_segments(segments, window_range, span), span)
 
-            data, label = h5_dataset.make_tensor(window_len, pose_id)
+                with self.profiler.stage('window_labels', windows=start.shape[0]):
+                    label = make_window_label(self.store.joint[offset: offset + num_frame],
+                                              self.store.root_rotation[offset: offset + num_frame], name,
+                                              start, window_len, self.dilation)
 
-            data_tensor.append(data)
-            label_tensor.append(label)
-        
-        data_tensor = torch.cat(data_tensor, dim=0)
-        label_tensor = torch.cat(label_tensor, dim=0)
+                with self.profiler.stage('tensor_conversion'):
+                    label_tensor.append(torch.from_numpy(label))
+            window_session.append(np.full(label.shape[0], i))
+            window_start.append(offset + start)
 
-        return (data_tensor, label_tensor)
+        with self.profiler.stage('torch_cat', sessions=len(grouping)):
+            label_tensor = torch.cat(label_tensor + [torch.from_numpy(self.empty_label())], dim=0)
+            window_session = np.concatenate(window_session + [np.zeros(0, dtype=np.int64)])
+            window_start = np.concatenate(window_start + [np.zeros(0, dtype=np.int64)])
+
+        return (label_tensor, window_session, window_start)
+
+    def read_window(self, session:int, start:int):
+        '''
+        Read one window of a session from disk as a tensor of the storage dtype.
+        The frames spanned by a window are read as one chunk, dilated windows keep every dilation-th frame.
+        '''
+        span = window_span(self.window_len, self.dilation)
+        if(self.store is not None):
+            return self.store.read_pressure(np.arange(start, start + span, self.dilation), decode=False)
+        pressure = self.sessions[session].read_pressure(start, start + span)[::self.dilation]
+        return pressure_to_tensor(encode_pressure(pressure, self.pressure_dtype))
+
+    def read_windows(self, session:np.ndarray, start:np.ndarray):
+        '''
+        Read windows [B, window_len, 2, 64, 32] in the storage dtype, in lazy mode.
+        The frames spanned by the windows of a session are read as one chunk unless the span is larger
+        than the windows themselves, e.g. for shuffled indices, then each window is read on its own.
+        '''
+        span = window_span(self.window_len, self.dilation)
+        offset = np.arange(self.window_len) * self.dilation
+        windows = [None] * start.shape[0]
+        for k in np.unique(session):
+            position = np.where(session == k)[0]
+            first, stop = int(start[position].min()), int(start[position].max()) + span
+            if(stop - first > position.shape[0] * span):
+                for i in position:
+                    windows[i] = self.read_window(k, start[i])
+                continue
+            if(self.store is not None):
+                chunk = self.store.read_pressure(np.arange(first, stop), decode=False)
+            else:
+                chunk = pressure_to_tensor(encode_pressure(self.sessions[k].read_pressure(first, stop), self.pressure_dtype))
+            frame_index = torch.from_numpy(start[position][:, None] - first + offset)
+            for (i, window) in zip(position, chunk[frame_index]):
+                windows[i] = window
+        return torch.stack(windows)
+
+    def decode_pressure(self, pressure:torch.Tensor):
+        '''
+        Normalized float32 pressure of windows or batches returned with defer_normalize.
+        '''
+        return decode_pressure(pressure, self.pressure_normalize)
+
+    def make_runs(self):
+        '''
+        Index of the windows accessed with window_stride, built from the runs of consecutive windows (see window_runs).
+        Run r of run_count[r] windows contributes n[r] = ceil(run_count[r] / window_stride) windows
+        run_first[r] + run_offset[r] + window_stride * [0, n[r]), the offset is below
+        run_count[r] - (n[r] - 1) * window_stride, so windows stay in their run and their number does not depend on it.
+        Offsets are a tensor moved to shared memory by share_memory, so set_epoch reaches DataLoader workers.
+        '''
+        runs = window_runs(self.window_start, self.window_session if self.lazy else None)
+        self.run_first = runs[:, 0]
+        run_windows = -(-runs[:, 1] // self.window_stride)
+        self.run_end = np.cumsum(run_windows)
+        self.run_begin = self.run_end - run_windows
+        self.run_offset_range = runs[:, 1] - (run_windows - 1) * self.window_stride
+        self.run_offset = torch.zeros(runs.shape[0], dtype=torch.int64)
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch:int):
+        '''
+        Draw the window offset of every posture segment for epoch when random_offset is set, call it before each epoch.
+        Offsets only depend on seed and epoch, so they agree in all processes.
+        '''
+        if(not self.random_offset or self.window_stride == 1):
+            return
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        offset_range = torch.from_numpy(self.run_offset_range)
+        offset = (torch.rand(offset_range.shape, dtype=torch.float64, generator=generator) * offset_range).long()
+        self.run_offset.copy_(torch.minimum(offset, offset_range - 1))
+
+    def window_position(self, index):
+        '''
+        Position in window_start and label_tensor of a dataset index or an array of them, computed on access.
+        '''
+        if(self.window_stride == 1):
+            return index
+        run = np.searchsorted(self.run_end, index, side='right')
+        return self.run_first[run] + self.run_offset.numpy()[run] + (index - self.run_begin[run]) * self.window_stride
 
     def __getitem__(self, index):
-        return self.data_tensor[index], self.label_tensor[index]
+        '''
+        One window (pressure [window_len, 2, 64, 32], label [LABEL_SCHEMA.SIZE]),
+        or a whole batch for a list of indices (see get_batch).
+        '''
+        if(not np.isscalar(index)):
+            return self.get_batch(index)
+        position = self.window_position(index)
+        start = self.window_start[position]
+        if(self.lazy):
+            pressure = self.read_window(self.window_session[position], start)
+        else:
+            pressure = self.pressure_tensor[start: start + window_span(self.window_len, self.dilation): self.dilation]
+        if(not self.defer_normalize):
+            pressure = self.decode_pressure(pressure)
+        return pressure, self.label_tensor[position]
+
+    def get_batch(self, indices:list):
+        '''
+        Batch access, returns one batch (pressure [B, window_len, 2, 64, 32], labels [B, LABEL_SCHEMA.SIZE]).
+        DataLoaders of make_data_loader read whole batches this way, a plain DataLoader reads single windows.
+        Windows of the in-memory buffer are gathered by a single index operation, numpy indexing copies whole frames
+        and is faster than tensor indexing here.
+        '''
+        position = self.window_position(np.asarray(indices, dtype=np.int64))
+        start = self.window_start[position]
+        if(self.lazy):
+            pressure = self.read_windows(self.window_session[position], start)
+        else:
+            frame_index = start[:, None] + np.arange(self.window_len) * self.dilation
+            pressure = torch.from_numpy(self.pressure_tensor.numpy()[frame_index])
+        if(not self.defer_normalize):
+            pressure = self.decode_pressure(pressure)
+        return pressure, self.label_tensor[torch.from_numpy(position)]
+
+    def share_memory(self):
+        '''
+        Move the pressure buffer and labels to shared memory, so DataLoader workers started by spawn or forkserver
+        map the same pages instead of receiving copies.
+        '''
+        if(not self.lazy):
+            self.pressure_tensor.share_memory_()
+        self.label_tensor.share_memory_()
+        self.run_offset.share_memory_()
+        return self
     
     def __len__(self):
-        return self.data_tensor.size()[0]    
-        
\ No newline at end of file
+        if(self.window_stride == 1):
+            return self.window_start.shape[0]
+        return int(self.run_end[-1]) if self.run_end.shape[0] > 0 else 0
+
+def collate_batch(batch):
+    '''
+    Pass-through collate_fn for batches built by SMART_GARMENT_DATASET.get_batch.
+    '''
+    return batch
+
+def make_data_loader(dataset:SMART_GARMENT_DATASET, batch_size:int, shuffle:bool = True, num_workers:int = 0,
+                     pin_memory:bool = False, drop_last:bool = False, sampler:Sampler = None, **kwargs):
+    '''
+    DataLoader reading whole batches through get_batch, the dataset is moved to shared memory for the workers.
+    Batches of indices are drawn by a BatchSampler over sampler (e.g. SHARD_SAMPLER), by default a random
+    or sequential sampler depending on shuffle. An empty dataset (e.g. an empty shard) yields no batches.
+    '''
+    if(num_workers > 0):
+        dataset.share_memory()
+    if(sampler is None):
+        sampler = RandomSampler(dataset) if shuffle and len(dataset) > 0 else SequentialSampler(dataset)
+    return DataLoader(dataset, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last),
+                      num_workers=num_workers, collate_fn=collate_batch, pin_memory=pin_memory,
+                      persistent_workers=num_workers > 0, **kwargs)
+
+class DEVICE_PREFETCHER:
+    '''
+    Iterate a DataLoader with batches already on device, the copy of the next batch overlaps the current step.
+    On CUDA the next batch is copied on a side stream, batches should come from pinned memory (pin_memory=True)
+    so the copy is asynchronous. decode, e.g. dataset.decode_pressure, normalizes pressure on the device.
+    '''
+    def __init__(self, loader:DataLoader, device, decode = None):
+
+        self.loader = loader
+        self.device = torch.device(device)
+        self.decode = decode
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+
+        pressure, label = batch
+        with (torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext()):
+            pressure = pressure.to(self.device, non_blocking=True)
+            label = label.to(self.device, non_blocking=True)
+            if(self.decode is not None):
+                pressure = self.decode(pressure)
+        return (pressure, label)
+
+    def __iter__(self):
+
+        iterator = iter(self.loader)
+        next_batch = None
+        for batch in iterator:
+            batch = self.to_device(batch)
+            if(next_batch is not None):
+                yield self.wait(next_batch)
+            next_batch = batch
+        if(next_batch is not None):
+            yield self.wait(next_batch)
+
+    def wait(self, batch):
+        '''
+        Make the compute stream wait for the copy of batch, and keep its memory alive until the compute is done.
+        '''
+        if(self.stream is not None):
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            for tensor in batch:
+                tensor.record_stream(torch.cuda.current_stream(self.device))
+        return batch
+
+class SHARD_SAMPLER(Sampler):
+    '''
+    Sampler of a sharded SMART_GARMENT_DATASET, the distributed counterpart of shuffling.
+    Every rank draws the same number of windows per epoch, the largest shard size over all ranks,
+    smaller shards repeat windows to fill up, shards of split sessions differ by one window at most (see shard_grouping).
+    Windows are reshuffled every epoch, call set_epoch before each epoch.
+    A shard without windows cannot fill up, then every rank raises ValueError when the sampler is created.
+    '''
+    def __init__(self, dataset:SMART_GARMENT_DATASET, shuffle:bool = True, seed:int = 0, num_samples:int = None):
+        '''
+        num_samples is the number of windows per rank and epoch,
+        by default the largest shard size, gathered over torch.distributed when it is initialized
+        '''
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        '''
+        Largest and smallest shard size, the smallest is gathered as the maximum of the negative size.
+        '''
+        size = torch.tensor([len(dataset), -len(dataset)], dtype=torch.int64)
+        if(dataset.num_replicas > 1 and distributed.is_available() and distributed.is_initialized()):
+            if(distributed.get_backend() == 'nccl'):
+                size = size.cuda()
+            distributed.all_reduce(size, op=distributed.ReduceOp.MAX)
+        largest, smallest = int(size[0].item()), -int(size[1].item())
+        if(num_samples is None):
+            num_samples = largest
+        if(smallest == 0 and num_samples > 0):
+            raise ValueError(f'a shard holds no windows (rank {dataset.rank} holds {len(dataset)}), '
+                             f'use fewer ranks.')
+        self.num_samples = num_samples
+
+    def set_epoch(self, epoch:int):
+        '''
+        Set the epoch of the sampler and of the dataset (see SMART_GARMENT_DATASET.set_epoch).
+        '''
+        self.epoch = epoch
+        self.dataset.set_epoch(epoch)
+
+    def __iter__(self):
+
+        if(self.shuffle):
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch * self.dataset.num_replicas + self.dataset.rank)
+            index = torch.randperm(len(self.dataset), generator=generator)
+        else:
+            index = torch.arange(len(self.dataset))
+        index = index.repeat(-(-self.num_samples // max(len(self.dataset), 1)))[:self.num_samples]
+        return iter(index.tolist())
+
+    def __len__(self):
+        return self.num_samples
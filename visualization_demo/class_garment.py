@@ -1,9 +1,69 @@
 import numpy as np
 import vtk
 import json
-import math
 from vtkmodules.util import numpy_support
 
+'''
+
+region id of vertices, index of REGION_NAME
+'''
+REGION_NAME = ['none', 'body', 'left_arm', 'right_arm', 'left_leg', 'right_leg']
+
+def cylinder_phi_z(points: np.ndarray, start: np.ndarray, axis: np.ndarray, length: float, reference: np.ndarray):
+    '''
+
+    calculate phi, z value of many points on one local cylinder at once
+    :param points: ndarray of coordinates [M, 3] in global system
+    :param start: the lower segmentation point of the cylinder
+    :param axis: normalized cylinder axis
+    :param length: length of the cylinder axis
+    :param reference: reference vector for phi calculation
+    :return: tuple contains (phi, z) ndarrays in shape [M]
+    '''
+    relative = points - start
+    '''
+
+    z is the projection length of vector [input_point, self.start] on axis
+    '''
+    z = relative[:, 0] * axis[0] + relative[:, 1] * axis[1] + relative[:, 2] * axis[2]
+    '''
+
+    phi is the angle that reference rotate to vec counter-clockwise
+    '''
+    vec = relative - z[:, None] * axis
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vec = vec / np.linalg.norm(vec, axis=1, keepdims=True)
+        cosPhi = vec[:, 0] * reference[0] + vec[:, 1] * reference[1] + vec[:, 2] * reference[2]
+        sign = np.sign(reference[2] * vec[:, 0] - reference[0] * vec[:, 2])
+        angle = np.arccos(cosPhi)
+    Phi = np.where(sign >= 0, angle, 2 * np.pi - angle)
+    return (Phi / (2 * np.pi), z / length)
+
+def make_lookup_table():
+    '''
+
+    lookup table shared by the Qt view and the offscreen renderer
+    value 0 is inserted to distinguish area cover and not covered by garment
+    area covered by garment is colored from blue to red as pressure grows
+    area not covered by garment shows original texture
+    :return: vtkLookupTable
+    '''
+    lut = vtk.vtkLookupTable()
+    lut.SetAlphaRange(1, 1)
+    lut.SetHueRange(0.67, 0)
+    lut.SetNumberOfColors(256)
+    lut.Build()
+    lut.SetTableValue(0, [128,128,128,1])
+    return lut
+
+def cylinder_axis(start: np.ndarray, end: np.ndarray):
+    '''
+
+    :return: tuple contains normalized axis (start, end) and its length
+    '''
+    length = np.linalg.norm(end - start)
+    return ((end - start) / length, length)
+
 class SMART_GARMENT:
 
     def __init__(self, config_file_path: str, obj_file_path: str):
@@ -11,11 +71,17 @@ class SMART_GARMENT:
         
         :param config_file_path: IO & ADC layout of smart garment
         :param obj_file_path: .obj 3D human model object
+        :var   gather_index: position of every vertex in the flat [cloths, pants, 0] value array
+        :var   scalar_buffer: float32 ndarray shared without copy by the vtkFloatArray self.scalars
         '''
         with open(config_file_path) as config_file:
             self.config = json.load(config_file)["normal"]
         
         self.obj = OBJ_MODEL(obj_file_path)
+        self.gather_shape = None
+        self.gather_index = None
+        self.scalar_buffer = None
+        self.scalars = None
 
     def set_pressure_data(self, cloths_data: np.ndarray, pants_data: np.ndarray):
         '''
@@ -26,41 +92,84 @@ class SMART_GARMENT:
         self.cloths_data = cloths_data
         self.pants_data = pants_data
 
-    def make_vtk_scalar(self):
-        '''
-        
-        make scalar for vtk using self.cloths_data and self.pants_data
-        :return: vtkFloatArray used to color .obj model in VTK
+    def make_gather_index(self, cloths_shape: tuple, pants_shape: tuple):
         '''
-        phi_z_list = self.obj.get_phi_z_all_vertices()
-        scalars = vtk.vtkFloatArray()
 
-        for item in phi_z_list:
+        resolve the channel of every vertex once
+        cloths channel (IO, ADC) maps to IO * cloths_shape[1] + ADC, pants channels follow all cloths channels,
+        vertices without channel map to the last position, which always holds value 0
+        :return: int64 ndarray of positions in the flat value array
+        '''
+        region, phi, z = self.obj.get_phi_z_all_vertices(dtype=np.float64)
+        cloths_size = cloths_shape[0] * cloths_shape[1]
+        sentinel = cloths_size + pants_shape[0] * pants_shape[1]
+        gather_index = np.full(region.shape[0], sentinel, dtype=np.int64)
 
-            if(item[0] == 'none'):
-                scalars.InsertNextValue(0)
-            
-            elif(item[0] == 'left_leg' or item[0] == 'right_leg'):
+        for name in REGION_NAME[1:]:
+            mask = region == REGION_NAME.index(name)
+            horizontal = np.array(self.config[name]["horizontal"])
+            vertical = np.array(self.config[name]["vertical"])
+            '''
+
+            phi & z decide which channel to select
+            '''
+            IO = horizontal[np.minimum(np.floor(z[mask] * len(horizontal)).astype(np.int64), len(horizontal) - 1)]
+            ADC = vertical[np.minimum(np.floor(phi[mask] * len(vertical)).astype(np.int64), len(vertical) - 1)]
+
+            if(name == 'left_leg' or name == 'right_leg'):
                 '''
-                
+
                 pants config have prefix 'left_leg' or 'right_leg'
-                phi & z decide which channel to select
                 '''
-                IO = self.config[item[0]]["horizontal"][math.floor(item[2] * len(self.config[item[0]]["horizontal"]))]
-                ADC = self.config[item[0]]["vertical"][math.floor(item[1] * len(self.config[item[0]]["vertical"]))]
-                scalars.InsertNextValue(self.pants_data[IO][ADC] + 50)
+                gather_index[mask] = cloths_size + IO * pants_shape[1] + ADC
             else:
-                IO = self.config[item[0]]["horizontal"][math.floor(item[2] * len(self.config[item[0]]["horizontal"]))]
-                ADC = self.config[item[0]]["vertical"][math.floor(item[1] * len(self.config[item[0]]["vertical"]))]
-                if(IO >= 48 and IO < 52 and ADC >= 8 and ADC < 16):
-                    '''
-                    
-                    front half of body have 4 horizontal stripes less than back half
-                    '''
-                    scalars.InsertNextValue(0)
-                else:
-                    scalars.InsertNextValue(self.cloths_data[IO][ADC] + 50)
-        return scalars
+                '''
+
+                front half of body have 4 horizontal stripes less than back half
+                '''
+                missing = (IO >= 48) & (IO < 52) & (ADC >= 8) & (ADC < 16)
+                gather_index[mask] = np.where(missing, sentinel, IO * cloths_shape[1] + ADC)
+        return gather_index
+
+    def compute_scalar(self, cloths_data: np.ndarray, pants_data: np.ndarray, out: np.ndarray = None):
+        '''
+
+        color all vertices with one vectorized take, safe to call outside the GUI thread
+        :param cloths_data: cloths pressure data, ndarray in shape [56, 40]
+        :param pants_data: pants pressure data, ndarray in shape [64, 32]
+        :param out: optional float32 ndarray receiving the scalars of all vertices
+        :return: float32 ndarray of scalars of all vertices
+        '''
+        shape = (cloths_data.shape, pants_data.shape)
+        if(self.gather_shape != shape):
+            self.gather_index = self.make_gather_index(cloths_data.shape, pants_data.shape)
+            self.gather_shape = shape
+
+        cloths_size = cloths_data.size
+        flat_buffer = np.empty(cloths_size + pants_data.size + 1, dtype=np.float32)
+        '''
+
+        value 50 is added to distinguish covered area with 0 pressure from area not covered by garment
+        '''
+        flat_buffer[:cloths_size] = cloths_data.ravel() + 50
+        flat_buffer[cloths_size:-1] = pants_data.ravel() + 50
+        flat_buffer[-1] = 0
+        return np.take(flat_buffer, self.gather_index, out=out)
+
+    def make_vtk_scalar(self):
+        '''
+        
+        make scalar for vtk using self.cloths_data and self.pants_data
+        the same vtkFloatArray is reused and updated in place by every call
+        :return: vtkFloatArray used to color .obj model in VTK
+        '''
+        if(self.scalars is None):
+            self.scalar_buffer = np.zeros(self.obj.vertices.shape[0], dtype=np.float32)
+            self.scalars = numpy_support.numpy_to_vtk(self.scalar_buffer, deep=False, array_type=vtk.VTK_FLOAT)
+
+        self.compute_scalar(self.cloths_data, self.pants_data, out=self.scalar_buffer)
+        self.scalars.Modified()
+        return self.scalars
 
 class OBJ_MODEL:
 
@@ -122,58 +231,56 @@ class OBJ_MODEL:
         '''
         return (z >= 0 and z <= 1 and phi >=0 and phi <= 1)
     
-    def get_phi_z_all_vertices(self):
+    def get_area_all_vertices(self):
+        '''
+
+        locate local cylinders of all vertices at once, following the same rules as get_area
+        head vertices and vertices around the neck are marked as 'none'
+        :return: int8 ndarray of region id (index of REGION_NAME) of all vertices
+        '''
+        x = self.vertices[:, 0]
+        y = self.vertices[:, 1]
+        head = y > 156
+        arm = ~head & (((np.abs(x) > 20) & (y < 110)) | ((np.abs(x) > 16) & (y >= 110)))
+        body = ~head & ~arm & (y > 110)
+        leg = ~head & ~arm & ~body
+
+        region = np.zeros(self.vertices.shape[0], dtype=np.int8)
+        region[arm & (x > 0)] = REGION_NAME.index('left_arm')
+        region[arm & (x <= 0)] = REGION_NAME.index('right_arm')
+        region[body & ~((y > 150) & (self.vertices[:, 2] > -5))] = REGION_NAME.index('body')
+        region[leg & (x > 0)] = REGION_NAME.index('left_leg')
+        region[leg & (x <= 0)] = REGION_NAME.index('right_leg')
+        return region
+
+    def get_phi_z_all_vertices(self, dtype=np.float32):
         '''
         
         calculate phi, z value of all vertices
         phi and z are shaped into 0-1 ratio form
-        :return: ndarray containing (cylinder id, phi, z) value of all vertices on .obj model
-        '''
-        phi_z_list = []
-
-        for point in self.vertices:
-
-            area = self.get_area(point)
-
-            if(area == 'body'):
-                phi, z = self.body.get_phi_z(point)
-                if(self.check_phi_z_valid(phi, z)):
-                    phi_z_list.append(['body', phi, z])
-                else:
-                    phi_z_list.append(['none', -1, -1])
-
-            elif(area == 'left_arm'):
-                phi, z = self.left_arm.get_phi_z(point)
-                if(self.check_phi_z_valid(phi, z)):
-                    phi_z_list.append(['left_arm', phi, z])
-                else:
-                    phi_z_list.append(['none', -1, -1])
-
-            elif(area == 'right_arm'):
-                phi, z = self.right_arm.get_phi_z(point)
-                if(self.check_phi_z_valid(phi, z)):
-                    phi_z_list.append(['right_arm', phi, z])
-                else:
-                    phi_z_list.append(['none', -1, -1])
-
-            elif(area == 'left_leg'):
-                phi, z = self.left_leg.get_phi_z(point)
-                if(self.check_phi_z_valid(phi, z)):
-                    phi_z_list.append(['left_leg', phi, z])
-                else:
-                    phi_z_list.append(['none', -1, -1])
-
-            elif(area == 'right_leg'):
-                phi, z = self.right_leg.get_phi_z(point)
-                if(self.check_phi_z_valid(phi, z)):
-                    phi_z_list.append(['right_leg', phi, z])
-                else:
-                    phi_z_list.append(['none', -1, -1])
+        :param dtype: dtype of returned phi and z, computation itself is done in float64
+        :return: tuple of (region id int8, phi, z) ndarrays of all vertices on .obj model,
+                 vertices not covered by any cylinder have region id 0 ('none') and phi = z = -1
+        '''
+        region = self.get_area_all_vertices()
+        phi = np.full(self.vertices.shape[0], -1, dtype=np.float64)
+        z = np.full(self.vertices.shape[0], -1, dtype=np.float64)
 
-            else:
-                phi_z_list.append(['none', -1, -1])
+        cylinders = {'body': self.body, 'left_arm': self.left_arm, 'right_arm': self.right_arm,
+                     'left_leg': self.left_leg, 'right_leg': self.right_leg}
+        for name, cylinder in cylinders.items():
+            mask = region == REGION_NAME.index(name)
+            phi[mask], z[mask] = cylinder.get_phi_z_batch(self.vertices[mask])
+        '''
+
+        comparisons with nan are False, so nan results are marked invalid as well
+        '''
+        valid = (z >= 0) & (z <= 1) & (phi >= 0) & (phi <= 1)
+        region[~valid] = REGION_NAME.index('none')
+        phi[~valid] = -1
+        z[~valid] = -1
 
-        return phi_z_list
+        return (region, phi.astype(dtype), z.astype(dtype))
 
 class ARM:
 
@@ -195,6 +302,7 @@ class ARM:
             slope = (self.end[1] - self.start[1]) / (self.end[0] - self.start[0])
             self.reference = np.array([-1, 1/slope, 0])
             self.reference = self.reference / np.linalg.norm(self.reference)
+            self.axis, self.length = cylinder_axis(self.start, self.end)
 
         elif(mode == 'right'):
             self.start = np.array([-30, 100, 0])
@@ -202,6 +310,7 @@ class ARM:
             slope = (self.end[1] - self.start[1]) / (self.end[0] - self.start[0])
             self.reference = np.array([1, -1/slope, 0])
             self.reference = self.reference / np.linalg.norm(self.reference)
+            self.axis, self.length = cylinder_axis(self.start, self.end)
 
         else:
             raise ValueError("param mode must be 'left' or 'right'.")
@@ -215,8 +324,7 @@ class ARM:
         '''
         if(type(input_point) != np.ndarray):
             input_point = np.array(input_point)
-        axis = self.end - self.start
-        axis = axis / np.linalg.norm(axis)
+        axis = self.axis
         '''
         
         z is the projection length of vector [input_point, self.start] on axis
@@ -231,7 +339,16 @@ class ARM:
         cosPhi = np.dot(self.reference, vec)
         sign = np.sign(np.cross(self.reference, vec)[1])
         Phi = np.arccos(cosPhi) if sign >= 0 else (2 * np.pi - np.arccos(cosPhi))
-        return (Phi / (2 * np.pi), z / np.linalg.norm(self.end - self.start))
+        return (Phi / (2 * np.pi), z / self.length)
+
+    def get_phi_z_batch(self, input_points: np.ndarray):
+        '''
+
+        calculate phi, z value of many points at once
+        :param input_points: ndarray of coordinates [M, 3] in global system
+        :return: tuple contains (phi, z) ndarrays in shape [M]
+        '''
+        return cylinder_phi_z(input_points, self.start, self.axis, self.length, self.reference)
 
 class LEG:
 
@@ -251,11 +368,13 @@ class LEG:
             self.start = np.array([10, 15, 0])
             self.end = np.array([10, 110, 0])
             self.reference = np.array([-1, 0, 0])
+            self.axis, self.length = cylinder_axis(self.start, self.end)
 
         elif(mode == 'right'):
             self.start = np.array([-10, 15, 0])
             self.end = np.array([-10, 110, 0])
             self.reference = np.array([1, 0, 0])
+            self.axis, self.length = cylinder_axis(self.start, self.end)
 
         else:
             raise ValueError("mode must be 'left' or 'right'.")
@@ -269,8 +388,7 @@ class LEG:
         '''
         if(type(input_point) != np.ndarray):
             input_point = np.array(input_point)
-        axis = self.end - self.start
-        axis = axis / np.linalg.norm(axis)
+        axis = self.axis
         '''
         
         z is the projection length of vector [input_point, self.start] on axis
@@ -285,7 +403,16 @@ class LEG:
         cosPhi = np.dot(self.reference, vec)
         sign = np.sign(np.cross(self.reference, vec)[1])
         Phi = np.arccos(cosPhi) if sign >= 0 else (2 * np.pi - np.arccos(cosPhi))
-        return (Phi / (2 * np.pi), z / np.linalg.norm(self.end - self.start))
+        return (Phi / (2 * np.pi), z / self.length)
+
+    def get_phi_z_batch(self, input_points: np.ndarray):
+        '''
+
+        calculate phi, z value of many points at once
+        :param input_points: ndarray of coordinates [M, 3] in global system
+        :return: tuple contains (phi, z) ndarrays in shape [M]
+        '''
+        return cylinder_phi_z(input_points, self.start, self.axis, self.length, self.reference)
     
 class BODY:
 
@@ -303,6 +430,7 @@ class BODY:
         self.start = np.array([0, 110, 0])
         self.end = np.array([0, 156, 0])
         self.reference = np.array([1, 0, 0])
+        self.axis, self.length = cylinder_axis(self.start, self.end)
 
     def get_phi_z(self, input_point: np.ndarray):
         '''
@@ -313,8 +441,7 @@ class BODY:
         '''
         if(type(input_point) != np.ndarray):
             input_point = np.array(input_point)
-        axis = self.end - self.start
-        axis = axis / np.linalg.norm(axis)
+        axis = self.axis
         '''
         
         z is the projection length of vector [input_point, self.start] on axis
@@ -329,4 +456,13 @@ class BODY:
         cosPhi = np.dot(self.reference, vec)
         sign = np.sign(np.cross(self.reference, vec)[1])
         Phi = np.arccos(cosPhi) if sign >= 0 else (2 * np.pi - np.arccos(cosPhi))
-        return (Phi / (2 * np.pi), z / np.linalg.norm(self.end - self.start))
+        return (Phi / (2 * np.pi), z / self.length)
+
+    def get_phi_z_batch(self, input_points: np.ndarray):
+        '''
+
+        calculate phi, z value of many points at once
+        :param input_points: ndarray of coordinates [M, 3] in global system
+        :return: tuple contains (phi, z) ndarrays in shape [M]
+        '''
+        return cylinder_phi_z(input_points, self.start, self.axis, self.length, self.reference)
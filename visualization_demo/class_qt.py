@@ -1,5 +1,8 @@
-from PyQt5 import QtWidgets
+from PyQt5 import QtWidgets, QtCore
+import numpy as np
 import vtk
+from class_stream import PLAYBACK_WORKER, PLAYBACK_STATS
+from class_garment import make_lookup_table
 from vtkmodules.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 
 class Ui(QtWidgets.QWidget):
@@ -54,24 +57,63 @@ class View(QtWidgets.QMainWindow):
         self.texture = self.GetTexture(f'./config/original_body_texture.bmp')
         self.mapper = vtk.vtkPolyDataMapper()
         self.mapper.SetInputConnection(self.reader.GetOutputPort())
-        lut = vtk.vtkLookupTable()
-        lut.SetAlphaRange(1, 1)
-        lut.SetHueRange(0.67, 0)
-        lut.SetNumberOfColors(256)
-        lut.Build()
-        '''
-        
-        value 0 is inserted to distinguish area cover and not covered by garment
-        area covered by garment is colored from blue to red as pressure grows
-        area not covered by garment shows original texture
-        '''
-        lut.SetTableValue(0, [128,128,128,1])
-        self.mapper.SetLookupTable(lut)
+        self.mapper.SetLookupTable(make_lookup_table())
         actor = vtk.vtkActor()
         actor.SetMapper(self.mapper)
         actor.SetTexture(self.texture)
         self.ren.AddActor(actor)
         self.iren.Initialize()
+        self.playback_worker = None
+        self.playback_timer = None
+
+    def start_playback(self, smart_garment, source, fps: float, queue_size: int = 4):
+        '''
+
+        update mesh scalars on a timer at sensor rate
+        frames are decoded and colored by a PLAYBACK_WORKER thread, the timer only shows the newest one
+        :param smart_garment: SMART_GARMENT computing vertex scalars
+        :param source: NPY_SOURCE, H5_SOURCE or SOCKET_SOURCE
+        :param fps: sensor rate, 30-60 Hz
+        :param queue_size: number of frames allowed to wait for the GUI
+        '''
+        smart_garment.set_pressure_data(np.zeros((56, 40)), np.zeros((64, 32)))
+        self.scalars = smart_garment.make_vtk_scalar()
+        self.scalar_buffer = smart_garment.scalar_buffer
+        self.reader.GetOutput().GetPointData().SetScalars(self.scalars)
+
+        self.playback_stats = PLAYBACK_STATS()
+        self.playback_worker = PLAYBACK_WORKER(smart_garment, source, queue_size)
+        self.playback_worker.start()
+
+        self.playback_timer = QtCore.QTimer(self)
+        self.playback_timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self.playback_timer.timeout.connect(self.update_playback)
+        self.playback_timer.start(max(int(1000 / fps), 1))
+
+    def update_playback(self):
+        '''
+
+        show the newest frame and report achieved FPS and latency in the window title
+        '''
+        frame = self.playback_worker.latest_frame()
+        if(frame is None):
+            return
+        scalars, capture_time = frame
+        self.scalar_buffer[:] = scalars
+        self.scalars.Modified()
+        self.ui.vtk_widget.GetRenderWindow().Render()
+
+        self.playback_stats.update(capture_time)
+        self.setWindowTitle(f'FPS: {self.playback_stats.fps():.1f}  '
+                            f'latency: {self.playback_stats.latency_ms():.1f} ms  '
+                            f'dropped: {self.playback_worker.num_dropped}')
+
+    def closeEvent(self, event):
+        if(self.playback_timer is not None):
+            self.playback_timer.stop()
+        if(self.playback_worker is not None):
+            self.playback_worker.stop()
+        QtWidgets.QMainWindow.closeEvent(self, event)
         
     def GetTexture(self, texture_path: str):
         '''
@@ -0,0 +1,179 @@
+import numpy as np
+import collections
+import queue
+import socket
+import threading
+import time
+
+'''
+
+sources yield frames as (cloths_data [56, 40], pants_data [64, 32], capture time from time.perf_counter())
+'''
+CLOTHS_SHAPE = (56, 40)
+PANTS_SHAPE = (64, 32)
+
+class NPY_SOURCE:
+
+    def __init__(self, cloths_file_path: str, pants_file_path: str, fps: float, loop: bool = True):
+        '''
+
+        multi-frame .npy files played back at sensor rate
+        :param cloths_file_path: .npy file in shape [T, 56, 40] or [56, 40]
+        :param pants_file_path: .npy file in shape [T, 64, 32] or [64, 32]
+        :param fps: playback rate
+        :param loop: restart from the first frame at the end of the files
+        '''
+        self.cloths_data = np.load(cloths_file_path, mmap_mode='r').reshape((-1,) + CLOTHS_SHAPE)
+        self.pants_data = np.load(pants_file_path, mmap_mode='r').reshape((-1,) + PANTS_SHAPE)
+        self.fps = fps
+        self.loop = loop
+
+    def frames(self, stop_event: threading.Event):
+        num_frame = min(self.cloths_data.shape[0], self.pants_data.shape[0])
+        next_time = time.perf_counter()
+        while(not stop_event.is_set()):
+            for i in range(num_frame):
+                if(stop_event.is_set()):
+                    return
+                '''
+
+                frames are paced like a live sensor
+                '''
+                next_time = next_time + 1 / self.fps
+                time.sleep(max(next_time - time.perf_counter(), 0))
+                yield (np.asarray(self.cloths_data[i]), np.asarray(self.pants_data[i]), time.perf_counter())
+            if(not self.loop):
+                return
+
+class H5_SOURCE(NPY_SOURCE):
+
+    def __init__(self, h5_file_path: str, fps: float, loop: bool = True):
+        '''
+
+        multi-frame .h5 file played back at sensor rate
+        :param h5_file_path: .h5 file with datasets 'cloths' [T, 56, 40] and 'pants' [T, 64, 32]
+        :param fps: playback rate
+        :param loop: restart from the first frame at the end of the file
+        '''
+        import h5py
+        self.h5_file = h5py.File(h5_file_path, 'r')
+        self.cloths_data = self.h5_file['cloths']
+        self.pants_data = self.h5_file['pants']
+        self.fps = fps
+        self.loop = loop
+
+class SOCKET_SOURCE:
+
+    def __init__(self, host: str, port: int):
+        '''
+
+        frames from a local TCP producer
+        every frame is 56 * 40 cloths values followed by 64 * 32 pants values, little-endian float32
+        :param host: producer host
+        :param port: producer port
+        '''
+        self.address = (host, port)
+        self.frame_size = 4 * (CLOTHS_SHAPE[0] * CLOTHS_SHAPE[1] + PANTS_SHAPE[0] * PANTS_SHAPE[1])
+
+    def frames(self, stop_event: threading.Event):
+        cloths_size = CLOTHS_SHAPE[0] * CLOTHS_SHAPE[1]
+        with socket.create_connection(self.address) as connection:
+            connection.settimeout(0.5)
+            buffer = bytearray(self.frame_size)
+            view = memoryview(buffer)
+            while(not stop_event.is_set()):
+                received = 0
+                while(received < self.frame_size and not stop_event.is_set()):
+                    try:
+                        num_byte = connection.recv_into(view[received:])
+                    except socket.timeout:
+                        continue
+                    if(num_byte == 0):
+                        return
+                    received = received + num_byte
+                if(received < self.frame_size):
+                    return
+                values = np.frombuffer(buffer, dtype='<f4').copy()
+                yield (values[:cloths_size].reshape(CLOTHS_SHAPE), values[cloths_size:].reshape(PANTS_SHAPE),
+                       time.perf_counter())
+
+class PLAYBACK_WORKER(threading.Thread):
+
+    def __init__(self, smart_garment, source, queue_size: int = 4):
+        '''
+
+        decode frames and compute vertex scalars off the GUI thread
+        the queue is bounded, the oldest frame is dropped when the GUI falls behind
+        :param smart_garment: SMART_GARMENT computing vertex scalars
+        :param source: NPY_SOURCE, H5_SOURCE or SOCKET_SOURCE
+        :param queue_size: number of frames allowed to wait for the GUI
+        '''
+        threading.Thread.__init__(self, daemon=True)
+        self.smart_garment = smart_garment
+        self.source = source
+        self.frame_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.num_dropped = 0
+
+    def run(self):
+        for (cloths_data, pants_data, capture_time) in self.source.frames(self.stop_event):
+            scalars = self.smart_garment.compute_scalar(cloths_data, pants_data)
+            while(True):
+                try:
+                    self.frame_queue.put_nowait((scalars, capture_time))
+                    break
+                except queue.Full:
+                    try:
+                        self.frame_queue.get_nowait()
+                        self.num_dropped = self.num_dropped + 1
+                    except queue.Empty:
+                        pass
+
+    def latest_frame(self):
+        '''
+
+        :return: newest (scalars, capture time) in the queue, older waiting frames are dropped, None if empty
+        '''
+        frame = None
+        while(True):
+            try:
+                newer_frame = self.frame_queue.get_nowait()
+            except queue.Empty:
+                return frame
+            if(frame is not None):
+                self.num_dropped = self.num_dropped + 1
+            frame = newer_frame
+
+    def stop(self):
+        self.stop_event.set()
+
+class PLAYBACK_STATS:
+
+    def __init__(self, window: float = 1.0, max_frames: int = 1024):
+        '''
+
+        achieved FPS and capture-to-display latency over a sliding time window
+        :param window: length of the sliding window in seconds
+        :param max_frames: most frames kept in the window
+        '''
+        self.window = window
+        self.display_time = collections.deque(maxlen=max_frames)
+        self.latency = collections.deque(maxlen=max_frames)
+
+    def update(self, capture_time: float):
+        now = time.perf_counter()
+        self.display_time.append(now)
+        self.latency.append(now - capture_time)
+        while(self.display_time[0] < now - self.window):
+            self.display_time.popleft()
+            self.latency.popleft()
+
+    def fps(self):
+        if(len(self.display_time) < 2):
+            return 0.0
+        return (len(self.display_time) - 1) / (self.display_time[-1] - self.display_time[0])
+
+    def latency_ms(self):
+        if(len(self.latency) == 0):
+            return 0.0
+        return 1000 * sum(self.latency) / len(self.latency)
@@ -1,24 +1,43 @@
 import class_garment
 import class_qt
+import class_stream
 
 import sys
+import argparse
 import numpy as np
 from PyQt5 import QtWidgets
 
 if __name__ == '__main__':
 
-    cloths_example, pants_example = sys.argv[1:]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', help='cloths and pants .npy files, or one .h5 file with --play')
+    parser.add_argument('--play', action='store_true', help='play multi-frame files at sensor rate')
+    parser.add_argument('--socket', help='HOST:PORT of a local frame producer')
+    parser.add_argument('--fps', type=float, default=30, help='sensor rate of playback')
+    args = parser.parse_args()
 
     smart_garment = class_garment.SMART_GARMENT(config_file_path=f'./config/config.json', 
                                                 obj_file_path=f'./config/20230108_man_2.obj')
-    smart_garment.set_pressure_data(np.load(cloths_example), 
-                                    np.load(pants_example))
-    scalar = smart_garment.make_vtk_scalar()
 
     app = QtWidgets.QApplication(sys.argv)
     win = class_qt.View()
-    win.reader.GetOutput().GetPointData().SetScalars(scalar)
     win.mapper.SetScalarRange(0, 600)
+
+    if(args.socket is not None):
+        host, port = args.socket.rsplit(':', 1)
+        win.start_playback(smart_garment, class_stream.SOCKET_SOURCE(host, int(port)), args.fps)
+    elif(args.play and len(args.files) == 1):
+        win.start_playback(smart_garment, class_stream.H5_SOURCE(args.files[0], args.fps), args.fps)
+    elif(args.play):
+        cloths_example, pants_example = args.files
+        win.start_playback(smart_garment, class_stream.NPY_SOURCE(cloths_example, pants_example, args.fps), args.fps)
+    else:
+        cloths_example, pants_example = args.files
+        smart_garment.set_pressure_data(np.load(cloths_example), 
+                                        np.load(pants_example))
+        scalar = smart_garment.make_vtk_scalar()
+        win.reader.GetOutput().GetPointData().SetScalars(scalar)
+
     win.iren.Initialize()
     win.show()
     sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,209 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import vtk
+from vtkmodules.util import numpy_support
+
+import class_garment
+
+'''
+
+headless rendering of pressure-on-body images, no display or Qt is needed
+on CPU-only Linux, select OSMesa or EGL with --backend (VTK reads VTK_DEFAULT_OPENGL_WINDOW)
+'''
+BACKEND = {
+    'egl': 'vtkEGLRenderWindow',
+    'osmesa': 'vtkOSOpenGLRenderWindow',
+}
+
+class OFFSCREEN_RENDERER:
+
+    def __init__(self, config_file_path: str, obj_file_path: str, texture_path: str = None, size: tuple = (603, 553)):
+        '''
+
+        the same VTK pipeline as class_qt.View, rendered into an offscreen window
+        one render window and one mesh are reused for all frames
+        :param config_file_path: IO & ADC layout of smart garment
+        :param obj_file_path: .obj 3D human model object
+        :param texture_path: optional .bmp texture for area not covered by garment
+        :param size: (width, height) of rendered images
+        '''
+        self.smart_garment = class_garment.SMART_GARMENT(config_file_path, obj_file_path)
+        self.smart_garment.set_pressure_data(np.zeros((56, 40)), np.zeros((64, 32)))
+        self.polydata = self.smart_garment.obj.reader.GetOutput()
+        self.polydata.GetPointData().SetScalars(self.smart_garment.make_vtk_scalar())
+
+        mapper = vtk.vtkPolyDataMapper()
+        mapper.SetInputData(self.polydata)
+        mapper.SetLookupTable(class_garment.make_lookup_table())
+        mapper.SetScalarRange(0, 600)
+        actor = vtk.vtkActor()
+        actor.SetMapper(mapper)
+        if(texture_path is not None and os.path.exists(texture_path)):
+            texture_reader = vtk.vtkBMPReader()
+            texture_reader.SetFileName(texture_path)
+            texture = vtk.vtkTexture()
+            texture.SetInputConnection(texture_reader.GetOutputPort())
+            actor.SetTexture(texture)
+
+        renderer = vtk.vtkRenderer()
+        renderer.SetBackground(0.5, 0.5, 0.5)
+        renderer.AddActor(actor)
+        camera = renderer.GetActiveCamera()
+        camera.SetPosition(0, 100, 500)
+        camera.SetFocalPoint(0, 100, 0)
+
+        self.render_window = vtk.vtkRenderWindow()
+        self.render_window.SetOffScreenRendering(1)
+        self.render_window.SetSize(size[0], size[1])
+        self.render_window.AddRenderer(renderer)
+
+        self.window_to_image = vtk.vtkWindowToImageFilter()
+        self.window_to_image.SetInput(self.render_window)
+        self.window_to_image.SetInputBufferTypeToRGB()
+        self.window_to_image.ReadFrontBufferOff()
+        self.png_writer = vtk.vtkPNGWriter()
+        self.png_writer.SetInputConnection(self.window_to_image.GetOutputPort())
+
+    def render(self, cloths_data: np.ndarray, pants_data: np.ndarray):
+        '''
+
+        :param cloths_data: cloths pressure data, ndarray in shape [56, 40]
+        :param pants_data: pants pressure data, ndarray in shape [64, 32]
+        :return: uint8 ndarray of the rendered image in shape [height, width, 3]
+        '''
+        self.smart_garment.set_pressure_data(cloths_data, pants_data)
+        self.smart_garment.make_vtk_scalar()
+        self.polydata.Modified()
+        self.render_window.Render()
+        self.window_to_image.Modified()
+        self.window_to_image.Update()
+
+        image = self.window_to_image.GetOutput()
+        width, height, depth = image.GetDimensions()
+        pixels = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(height, width, -1)
+        '''
+
+        VTK images start from the bottom row
+        '''
+        return pixels[::-1].copy()
+
+    def save_png(self, cloths_data: np.ndarray, pants_data: np.ndarray, png_path: str):
+        self.render(cloths_data, pants_data)
+        self.png_writer.SetFileName(png_path)
+        self.png_writer.Write()
+        return png_path
+
+'''
+
+one renderer per worker process, created by init_worker
+'''
+worker_renderer = None
+
+def init_worker(config_file_path: str, obj_file_path: str, texture_path: str, size: tuple):
+    global worker_renderer
+    worker_renderer = OFFSCREEN_RENDERER(config_file_path, obj_file_path, texture_path, size)
+
+def render_task(task: tuple):
+    '''
+
+    :param task: (cloths .npy path, pants .npy path, frame index or None for single-frame files, png path)
+    '''
+    cloths_path, pants_path, frame, png_path = task
+    cloths_data = np.load(cloths_path, mmap_mode='r')
+    pants_data = np.load(pants_path, mmap_mode='r')
+    if(frame is not None):
+        cloths_data = cloths_data[frame]
+        pants_data = pants_data[frame]
+    return worker_renderer.save_png(np.asarray(cloths_data), np.asarray(pants_data), png_path)
+
+def sequence_tasks(cloths_path: str, pants_path: str, out_dir: str):
+    '''
+
+    :return: render tasks of multi-frame files [T, 56, 40] and [T, 64, 32], one png per frame
+    '''
+    num_frame = min(np.load(cloths_path, mmap_mode='r').shape[0], np.load(pants_path, mmap_mode='r').shape[0])
+    return [(cloths_path, pants_path, i, os.path.join(out_dir, f'frame_{i:06d}.png')) for i in range(num_frame)]
+
+def directory_tasks(example_dir: str, out_dir: str):
+    '''
+
+    :return: render tasks of all [name]-cloths.npy / [name]-pants.npy pairs in example_dir, one png per pair
+    '''
+    tasks = []
+    for cloths_path in sorted(glob.glob(os.path.join(example_dir, '*-cloths.npy'))):
+        name = os.path.basename(cloths_path)[:-len('-cloths.npy')]
+        pants_path = os.path.join(example_dir, f'{name}-pants.npy')
+        if(os.path.exists(pants_path)):
+            tasks.append((cloths_path, pants_path, None, os.path.join(out_dir, f'{name}.png')))
+    return tasks
+
+def render_tasks(tasks: list, config_file_path: str, obj_file_path: str, texture_path: str = None,
+                 size: tuple = (603, 553), num_workers: int = 1):
+    '''
+
+    render tasks with num_workers processes, each process builds its renderer once
+    :return: png paths in task order
+    '''
+    time_start = time.perf_counter()
+    initargs = (config_file_path, obj_file_path, texture_path, size)
+    if(num_workers <= 1):
+        init_worker(*initargs)
+        png_paths = [render_task(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(num_workers, initializer=init_worker, initargs=initargs) as pool:
+            png_paths = pool.map(render_task, tasks, chunksize=max(len(tasks) // (4 * num_workers), 1))
+    print(f'Rendered {len(png_paths)} images with {num_workers} workers in {time.perf_counter() - time_start:.2f}s.')
+    return png_paths
+
+def write_video(png_paths: list, video_path: str, fps: float):
+    '''
+
+    assemble rendered images into .mp4 or .gif, requires package imageio (and imageio-ffmpeg for .mp4)
+    '''
+    try:
+        import imageio.v2 as imageio
+    except ImportError:
+        raise ImportError('writing videos requires imageio, install it with "pip install imageio imageio-ffmpeg".')
+    if(video_path.endswith('.gif')):
+        writer = imageio.get_writer(video_path, mode='I', duration=1 / fps)
+    else:
+        writer = imageio.get_writer(video_path, fps=fps)
+    with writer:
+        for png_path in png_paths:
+            writer.append_data(imageio.imread(png_path))
+    return video_path
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out_dir', help='directory of rendered .png images')
+    parser.add_argument('--sequence', nargs=2, metavar=('CLOTHS', 'PANTS'), help='multi-frame cloths and pants .npy files')
+    parser.add_argument('--directory', help='directory of [name]-cloths.npy / [name]-pants.npy pairs, e.g. ./example')
+    parser.add_argument('--video', help='also write the images into an .mp4 or .gif file')
+    parser.add_argument('--fps', type=float, default=30, help='frame rate of the video')
+    parser.add_argument('--workers', type=int, default=1, help='number of render processes')
+    parser.add_argument('--size', type=int, nargs=2, default=(603, 553), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--backend', choices=['auto'] + list(BACKEND.keys()), default='auto',
+                        help='offscreen OpenGL backend, auto keeps the VTK default')
+    args = parser.parse_args()
+
+    if(args.backend != 'auto'):
+        os.environ['VTK_DEFAULT_OPENGL_WINDOW'] = BACKEND[args.backend]
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    if(args.sequence is not None):
+        tasks = sequence_tasks(args.sequence[0], args.sequence[1], args.out_dir)
+    elif(args.directory is not None):
+        tasks = directory_tasks(args.directory, args.out_dir)
+    else:
+        sys.exit('one of --sequence or --directory is required.')
+
+    png_paths = render_tasks(tasks, f'./config/config.json', f'./config/20230108_man_2.obj',
+                             f'./config/original_body_texture.bmp', tuple(args.size), args.workers)
+    if(args.video is not None):
+        write_video(png_paths, args.video, args.fps)